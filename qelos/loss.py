@@ -6,12 +6,13 @@ import re
 import math
 from nltk.translate.bleu_score import sentence_bleu
 import warnings
+from qelos.word import _counts_array
 
 EPS = 1e-6
 
 
 __all__ = ["Accuracy", "SeqAccuracy", "SeqElemAccuracy", "MacroBLEU",
-           "SmoothedCELoss", "CELoss", "DistillLoss", "LinearLoss", "SelectedLinearLoss"]
+           "SmoothedCELoss", "CELoss", "AdaptiveCELoss", "SampledCELoss", "DistillLoss", "LinearLoss", "SelectedLinearLoss"]
 
 
 class LinearLoss(torch.nn.Module):
@@ -228,6 +229,7 @@ class CELoss(torch.nn.Module):
             raise q.SumTingWongException("unknown mode {}".format(mode))
 
     def forward(self, probs, gold):     # (batsize, ..., vocsize), (batsize, ...)
+        probs = probs.float()       # loss is computed in float32 (also if model ran in reduced precision)
         logprobs = probs if self.mode != "probs" else torch.log(probs)
         if logprobs.dim() > 2:
             permaxis = [0, logprobs.dim()-1] + list(range(1, logprobs.dim()-1))
@@ -236,6 +238,82 @@ class CELoss(torch.nn.Module):
         return ret
 
 
+class AdaptiveCELoss(torch.nn.Module):
+    """ Cross entropy loss for q.AdaptiveWordLinout. Takes hidden states instead of logits
+        and only computes the clusters needed for the gold ids. """
+    def __init__(self, linout, reduction="elementwise_mean", ignore_index=-100, **kw):
+        """
+        :param linout:      q.AdaptiveWordLinout to compute the output distribution with
+        """
+        super(AdaptiveCELoss, self).__init__(**kw)
+        self.linout = linout
+        self.reduction, self.ignore_indices = reduction, ignore_index
+
+    def forward(self, x, gold):     # (batsize, ..., dim), (batsize, ...)
+        mask = DiscreteLoss.get_ignore_mask(gold, self.ignore_indices)
+        gold = gold * mask.long()     # ignored positions get a valid id, masked out below
+        ret = - self.linout.gold_log_prob(x, gold) * mask.float()
+        if self.reduction == "elementwise_mean":
+            ret = ret.sum() / mask.float().sum()
+        elif self.reduction == "sum":
+            ret = ret.sum()
+        return ret
+
+
+class SampledCELoss(torch.nn.Module):
+    """ Sampled softmax cross entropy loss for models with a (large) q.WordLinout output layer.
+        Takes hidden states instead of logits.
+        During training (linout.training), only scores the gold ids and a number of negative ids,
+        sampled from a unigram proposal distribution shared by all elements in the batch
+        (no (batsize, ..., vocsize) logits are computed).
+        In eval mode, falls back to exact cross entropy over the full output of linout. """
+    def __init__(self, linout, counts, numsamples=1024, distortion=1., reduction="elementwise_mean",
+                 ignore_index=-100, **kw):
+        """
+        :param linout:      q.WordLinout whose weights and bias are used to compute the scores
+        :param counts:      word frequencies: dictionary mapping words to counts or sequence of counts per id.
+                            Add-one smoothed so that every id can be sampled.
+        :param numsamples:  number of negative ids to sample per batch
+        :param distortion:  proposal distribution is proportional to counts ** distortion
+        """
+        super(SampledCELoss, self).__init__(**kw)
+        self.linout, self.numsamples = linout, numsamples
+        self.reduction, self.ignore_indices = reduction, ignore_index
+        proposal = (_counts_array(counts, linout.D) + 1) ** distortion
+        proposal = proposal / proposal.sum()
+        self.register_buffer("proposal", torch.tensor(proposal, dtype=torch.float32))
+        self.register_buffer("logproposal", torch.log(self.proposal))
+        self.ce = CELoss(mode="logits", reduction=reduction, ignore_index=ignore_index)
+
+    def forward(self, x, gold):     # (batsize, ..., dim), (batsize, ...)
+        if not self.linout.training:
+            return self.ce(self.linout(x), gold)
+        mask = DiscreteLoss.get_ignore_mask(gold, self.ignore_indices)
+        gold = gold * mask.long()     # ignored positions get a valid id, masked out below
+        _x, _gold = x.reshape(-1, x.size(-1)), gold.reshape(-1)
+        samples = torch.multinomial(self.proposal, self.numsamples, replacement=True)    # (numsamples,)
+
+        goldscores = (_x * self.linout.weight[_gold]).sum(-1)     # (numel,)
+        samplescores = torch.matmul(_x, self.linout.weight[samples].t())     # (numel, numsamples)
+        if self.linout.bias is not None:
+            goldscores = goldscores + self.linout.bias[_gold]
+            samplescores = samplescores + self.linout.bias[samples].unsqueeze(0)
+        # correct for sampling probability
+        logexpected = self.logproposal + math.log(self.numsamples)
+        goldscores = goldscores - logexpected[_gold]
+        samplescores = samplescores - logexpected[samples].unsqueeze(0)
+        # sampled ids that are the gold id of an element don't count as negatives for that element
+        samplescores = samplescores.masked_fill(samples.unsqueeze(0) == _gold.unsqueeze(1), -np.inf)
+
+        scores = torch.cat([goldscores.unsqueeze(1), samplescores], 1)       # (numel, 1 + numsamples)
+        ret = - torch.log_softmax(scores, -1)[:, 0].view(gold.size()) * mask.float()
+        if self.reduction == "elementwise_mean":
+            ret = ret.sum() / mask.float().sum()
+        elif self.reduction == "sum":
+            ret = ret.sum()
+        return ret
+
+
 class SmoothedCELoss(torch.nn.Module):
     """ CrossEntropyLoss with label smoothing. """
     def __init__(self, reduction="elementwise_mean", ignore_index=-100, smoothing=0., mode="logits", **kw):
@@ -251,6 +329,7 @@ class SmoothedCELoss(torch.nn.Module):
         :param gold:    (batsize, ..., ) int ids of correct class
         :return:
         """
+        probs = probs.float()
         _prob_mask_crit = -np.infty if self.mode in "logits logprobs".split() else 0
         lsv = q.v(self.smoothing)   # get value of label smoothing hyperparam
         assert(lsv >= 0 and lsv <= 1)
@@ -302,6 +381,7 @@ class DistillLoss(torch.nn.Module):
         :param gold:        tuple of (batsize, ..., numsym) soft gold logits and (batsize, ...) ints for hard gold
         """
         softgold, hardgold = gold
+        probs, softgold = probs.float(), softgold.float()
         t = q.v(self.temperature)
         mix = q.v(self.mixture)
 
@@ -50,7 +50,7 @@ class RecCell(torch.nn.Module):
         """ interpolates between previous and new state inside a timestep in a batch based on mask"""
         mask_t = q.getkw(kw, "mask_t", None)
         if mask_t is not None:
-            mask_t = mask_t.float().unsqueeze(1)
+            mask_t = mask_t.to(statepairs[0][1].dtype).unsqueeze(1)
             ret = [h_t * mask_t + h_tm1 * (1 - mask_t) for h_tm1, h_t in statepairs]
             return tuple(ret)
         else:
@@ -289,7 +289,7 @@ class AttentionWithMonotonicCoverage(AttentionWithCoverage):
 class _DotAttention(AttentionBase):
     def _forward(self, qry, ctx, ctx_mask=None, values=None):
         scores = torch.bmm(ctx, qry.unsqueeze(2)).squeeze(2)
-        scores = scores + (torch.log(ctx_mask.float()) if ctx_mask is not None else 0)
+        scores = scores + (torch.log(ctx_mask.to(scores.dtype)) if ctx_mask is not None else 0)
         alphas = self.sm(scores)
         values = ctx if values is None else values
         summary = values * alphas.unsqueeze(2)
@@ -337,7 +337,7 @@ class _FwdAttention(AttentionBase):
         y = self.linear(x)      # (batsize, seqlen, attdim)
         y = self.nonlin(y)
         scores = self.afterlinear(y).squeeze(2)
-        scores = scores + (torch.log(ctx_mask.float()) if ctx_mask is not None else 0)
+        scores = scores + (torch.log(ctx_mask.to(scores.dtype)) if ctx_mask is not None else 0)
         alphas = self.sm(scores)
         values = ctx if values is None else values
         summary = values * alphas.unsqueeze(2)
@@ -362,7 +362,7 @@ class _FwdMulAttention(AttentionBase):
         y = self.linear(x)      # (batsize, seqlen, attdim)
         y = self.nonlin(y)
         scores = self.afterlinear(y).squeeze(2)
-        scores = scores + (torch.log(ctx_mask.float()) if ctx_mask is not None else 0)
+        scores = scores + (torch.log(ctx_mask.to(scores.dtype)) if ctx_mask is not None else 0)
         alphas = self.sm(scores)
         values = ctx if values is None else values
         summary = values * alphas.unsqueeze(2)
@@ -588,6 +588,9 @@ class FreeDecoder(Decoder):
         assert(ys.dim() == 2)   # (batsize, outsyms)
         _, argmax_ys = torch.max(ys, 1)
         xs = argmax_ys
+        out = getattr(self.cell, "out", None)
+        if isinstance(out, q.WordLinout):   # map back to global ids if out is shortlisted
+            xs = out.to_global(xs)
         return xs
 
 
@@ -1023,7 +1026,7 @@ class RNNLayerEncoderBase(torch.nn.Module):
         self.bias = bias
         self.layer_norm = torch.nn.ModuleList() if layer_norm is True else None
         self.dropout_in = torch.nn.Dropout(dropout_in, inplace=False) if dropout_in > 0 else None
-        self.dropout_in_shared = torch.nn.Dropout(dropout_in, inplace=False) if dropout_in_shared > 0 else None
+        self.dropout_in_shared = torch.nn.Dropout(dropout_in_shared, inplace=False) if dropout_in_shared > 0 else None
         self.dropconnect = dropconnect
         self.dropout_rec = dropout_rec
         self.make_layers()
@@ -1063,11 +1066,9 @@ class RNNLayerEncoderBase(torch.nn.Module):
 
     def _forward(self, x, mask=None, states_0=None, ret_states=False):
         """ top layer states return last """
-        order = None
-        packsorter = None
-        if mask is not None:
+        if mask is not None:        # packed once, sort order is carried by packed sequence (layers sort/unsort states)
             assert (not isinstance(x, torch.nn.utils.rnn.PackedSequence))
-            x, order, packsorter = q.seq_pack(x, mask=mask, ret_sorter=True)
+            x, _ = q.seq_pack(x, mask=mask)
         out = x
 
         # init states -- topmost layer matches latest provided states, if not enough states, bottoms get None
@@ -1076,8 +1077,6 @@ class RNNLayerEncoderBase(torch.nn.Module):
         for state_0 in states_0:
             h_0s_e = [] if state_0 is None else state_0     # one element of h_0s contains a list of states for a certain state of this rnn
             assert(len(h_0s_e) <= len(self.layers))
-            if order is not None:       # TODO: test !!! if x was packed, and init states provided, states must be sorted like x was sorted during packing
-                h_0s_e =  [h_0s_e_e.index_select(0, packsorter) for h_0s_e_e in h_0s_e]
             h_0s_e = [h_0s_e_e.transpose(1, 0) for h_0s_e_e in h_0s_e]      # transpose incoming states (they are batch-first while layers expect direction*numlayers first)
             h_0s_e = [None] * (len(self.layers) - len(h_0s_e)) + h_0s_e
             h_0s.append(h_0s_e)
@@ -1092,18 +1091,12 @@ class RNNLayerEncoderBase(torch.nn.Module):
             # region regularization
             if self.layer_norm is not None:
                 if mask is not None:
-                    out_normed = self.layer_norm[i](out.data)
-                    out = torch.nn.utils.rnn.PackedSequence(out_normed, out.batch_sizes)
+                    out = out._replace(data=self.layer_norm[i](out.data))     # keeps sort/unsort indexes
                 else:
-                    batsize, seqlen, hdim = out.size()
-                    _out = out.view(-1, hdim)
-                    _out = self.layer_norm[i](_out)
-                    out = out.view(batsize, seqlen, hdim)
-                # TODO test layernorm
+                    out = self.layer_norm[i](out)
             if self.dropout_in is not None and self.training:
                 if mask is not None:       # then sequence has been packed
-                    out_dropout = self.dropout_in(out.data)
-                    out = torch.nn.utils.rnn.PackedSequence(out_dropout, out.batch_sizes)
+                    out = out._replace(data=self.dropout_in(out.data))
                 else:
                     out = self.dropout_in(out)
                 # TODO: test dropouts
@@ -1111,8 +1104,7 @@ class RNNLayerEncoderBase(torch.nn.Module):
                 if mask is not None:
                     dropout_mask = torch.ones_like(out.data[0:1])
                     dropout_mask = self.dropout_in_shared(dropout_mask)
-                    out_dropout = out.data * dropout_mask
-                    out = torch.nn.utils.rnn.PackedSequence(out_dropout, out.batch_sizes)
+                    out = out._replace(data=out.data * dropout_mask)
                 else:
                     dropout_mask = torch.ones_like(out[0:1, 0:1])
                     dropout_mask = self.dropout_in_shared(dropout_mask)
@@ -1131,12 +1123,10 @@ class RNNLayerEncoderBase(torch.nn.Module):
             if not q.issequence(h_i_n):
                 h_i_n = (h_i_n,)
             h_i_n = [h_i_n_e.transpose(1, 0).contiguous() for h_i_n_e in h_i_n]
-            if order is not None:
-                h_i_n = [h_i_n_e.index_select(0, order) for h_i_n_e in h_i_n]
             states_to_ret.append(tuple(h_i_n))
             i += 1
         if mask is not None:
-            out, rmask = q.seq_unpack(out, order)
+            out, rmask = q.seq_unpack(out)
         if ret_states:
             stateret = states_to_ret if self.ret_all_states is True else states_to_ret[-1][0]
             return out, stateret
@@ -1203,9 +1193,9 @@ class RecCellEncoder(torch.nn.Module):
         out = torch.split(out, 1, 1)    # split in sequence dimension
         out = [out_e.squeeze(1) for out_e in out]
 
-        mask = (gate if mask is None else mask.float() * gate) \
+        mask = (gate if mask is None else mask.to(gate.dtype) * gate) \
                 if gate is not None \
-                else (mask.float() if mask is not None else None)
+                else (mask.to(x.dtype) if mask is not None else None)
 
         assert(len(self.layers) > 0)
         i = 0
@@ -1393,7 +1383,7 @@ class FlatEncoder(torch.nn.Module):
                 embs = self.adapt_lin(embs)
             meanpool = embs.sum(1)
             masksum = mask.float().sum(1).unsqueeze(1)
-            meanpool = meanpool / masksum
+            meanpool = (meanpool.float() / masksum).to(meanpool.dtype)
             final_state = final_state + meanpool
         if self.debug:
             return final_state, embs
@@ -0,0 +1,77 @@
+import torch
+import qelos as q
+import time
+from qelos.scripts.lm.rnnlm import RNNLayer_LM
+
+
+class TransformerLM(torch.nn.Module):
+    def __init__(self, dim, worddic, numlayers=2, numheads=4, maxlen=512, **kw):
+        super(TransformerLM, self).__init__(**kw)
+        self.emb = q.WordEmb(dim, worddic=worddic)
+        self.dec = q.TransformerDecoder(dim=dim, numlayers=numlayers, numheads=numheads, maxlen=maxlen, noctx=True)
+        self.out = q.WordLinout(dim, worddic=worddic)
+
+    def forward(self, x):
+        emb, mask = self.emb(x)
+        return self.out(self.dec(emb, mask=mask))
+
+
+def saved_tensor_bytes(f):
+    """ runs f and returns the number of bytes of tensors saved for backward (activation memory) """
+    total = [0]
+
+    def pack(t):
+        total[0] += t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        f()
+    return total[0]
+
+
+def run(vocsize=10000,
+        dim=256,
+        numlayers=2,
+        batsize=32,
+        seqlen=64,
+        steps=10,
+        cuda=False,
+        gpu=0,
+        ):
+    """ Compares float32 and bfloat16 autocast train_batch step time and activation memory for a transformer and an LSTM LM. """
+    device = torch.device("cuda", gpu) if cuda else torch.device("cpu")
+    D = {"<MASK>": 0}
+    D.update({"w{}".format(i): i for i in range(1, vocsize)})
+    x = torch.randint(1, vocsize, (batsize, seqlen + 1))
+    batch = (x[:, :-1], x[:, 1:])
+    print("vocsize {}, dim {}, {} layers, batsize {}, seqlen {} on {}".format(vocsize, dim, numlayers, batsize, seqlen, device))
+
+    models = [("transformer", lambda: TransformerLM(dim, D, numlayers=numlayers)),
+              ("lstm", lambda: RNNLayer_LM(*([dim] * (numlayers + 1)), worddic=D))]
+    for name, create in models:
+        base = None
+        for autocast in [False, True]:
+            torch.manual_seed(0)
+            m = create().to(device)
+            optim = torch.optim.SGD(m.parameters(), lr=0.1)
+            losses = [q.LossWrapper(q.CELoss(mode="logits"))]
+            step = lambda: q.train_batch(batch=batch, model=m, optim=optim, losses=losses, device=device,
+                                         autocast=autocast)
+            step()      # warmup
+            mem = saved_tensor_bytes(step)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            for _ in range(steps):
+                step()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            t = (time.perf_counter() - start) / steps
+            base = (t, mem) if base is None else base
+            print("{:>11} {:>8}: {:7.1f} ms/step ({:.2f}x), {:7.1f} MB saved activations ({:.2f}x), loss {:.4f}"
+                  .format(name, "bfloat16" if autocast else "float32", t * 1e3, base[0] / t,
+                          mem / 2**20, mem / base[1], losses[0].get_epoch_error()))
+
+
+if __name__ == '__main__':
+    q.argprun(run)
@@ -0,0 +1,78 @@
+import torch
+import qelos as q
+import time
+
+
+def seq_pack_old(x, mask, ret_sorter=False):
+    """ previous implementation of q.seq_pack (float cast, manual sort, lengths through numpy) """
+    x = x.float()
+    mask = mask.float()
+    lens = torch.sum(mask.float(), 1)
+    _, sortidxs = torch.sort(lens, descending=True)
+    unsorter = torch.zeros(sortidxs.size()).to(sortidxs.device).long()
+    unsorter.scatter_(0, sortidxs,
+           torch.arange(0, len(unsorter), dtype=torch.int64, device=sortidxs.device))
+    sortedseq = torch.index_select(x, 0, sortidxs)
+    sortedmsk = torch.index_select(mask, 0, sortidxs)
+    sortedlens = sortedmsk.long().sum(1)
+    sortedlens = list(sortedlens.cpu().detach().numpy())
+    packedseq = torch.nn.utils.rnn.pack_padded_sequence(sortedseq, sortedlens, batch_first=True)
+    if ret_sorter:
+        return packedseq, unsorter, sortidxs
+    else:
+        return packedseq, unsorter
+
+
+def seq_unpack_old(x, order, padding_value=0):
+    """ previous implementation of q.seq_unpack (mask built in python loop) """
+    unpacked, lens = torch.nn.utils.rnn.pad_packed_sequence(x, batch_first=True, padding_value=padding_value)
+    mask = torch.zeros(len(lens), max(lens), dtype=torch.int64, device=unpacked.device)
+    for i, l in enumerate(lens):
+        mask[i, :l] = 1
+    out = torch.index_select(unpacked, 0, order)
+    outmask = torch.index_select(mask, 0, order)
+    return out, outmask
+
+
+def timeit(f, reps, device):
+    for _ in range(3):      # warmup
+        f()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(reps):
+        f()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / reps
+
+
+def run(batsize=64,
+        seqlen=50,
+        dim=200,
+        reps=200,
+        cuda=False,
+        gpu=0,
+        ):
+    """ Measures per-batch overhead of packing + unpacking (no RNN in between) of old and current implementations. """
+    device = torch.device("cuda", gpu) if cuda else torch.device("cpu")
+    x = torch.randn(batsize, seqlen, dim, device=device)
+    lens = torch.randint(1, seqlen + 1, (batsize,), device=device)
+    mask = (torch.arange(seqlen, device=device)[None, :] < lens[:, None]).long()
+
+    def old():
+        packed, order = seq_pack_old(x, mask)
+        return seq_unpack_old(packed, order)
+
+    def new():
+        packed, order = q.seq_pack(x, mask)
+        return q.seq_unpack(packed)
+
+    t_old = timeit(old, reps, device)
+    t_new = timeit(new, reps, device)
+    print("batsize {}, seqlen {}, dim {} on {}".format(batsize, seqlen, dim, device))
+    print("old: {:.1f} us/batch, new: {:.1f} us/batch ({:.2f}x)".format(t_old * 1e6, t_new * 1e6, t_old / t_new))
+
+
+if __name__ == '__main__':
+    q.argprun(run)
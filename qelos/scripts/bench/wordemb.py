@@ -0,0 +1,47 @@
+import torch
+import qelos as q
+import time
+
+
+def timeit(f, reps, device):
+    for _ in range(3):      # warmup
+        f()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(reps):
+        f()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / reps
+
+
+def run(vocsize=100000,
+        dim=300,
+        batsize=64,
+        seqlen=50,
+        reps=200,
+        cuda=False,
+        gpu=0,
+        ):
+    """ Measures table memory and lookup throughput of WordEmb for the different storage dtypes. """
+    device = torch.device("cuda", gpu) if cuda else torch.device("cpu")
+    D = {"w{}".format(i): i for i in range(vocsize)}
+    W = torch.randn(vocsize, dim)
+    x = torch.randint(0, vocsize, (batsize, seqlen), device=device)
+    print("vocsize {}, dim {}, batsize {}, seqlen {} on {}".format(vocsize, dim, batsize, seqlen, device))
+    base = None
+    for storage in ["float32", "float16", "bfloat16", "int8"]:
+        emb = q.WordEmb(dim, worddic=D, _weight=W.clone()).freeze(storage=storage).to(device)
+        tensors = [emb.weight] + ([emb.weight_scale] if emb.weight_scale is not None else [])
+        mem = sum(t.numel() * t.element_size() for t in tensors)
+        err = (emb(x)[0] - W.to(device)[x]).abs().max().item()
+        with torch.no_grad():
+            t = timeit(lambda: emb(x), reps, device)
+        base = t if base is None else base
+        print("{:>8}: {:7.1f} MB, {:7.1f} us/batch ({:.2f}x), {:.2f} Mtokens/s, max abs error {:.4f}"
+              .format(storage, mem / 2**20, t * 1e6, base / t, batsize * seqlen / t / 1e6, err))
+
+
+if __name__ == '__main__':
+    q.argprun(run)
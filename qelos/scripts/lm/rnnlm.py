@@ -98,7 +98,7 @@ class LMLoader(object):
         return _LMLoaderIter(self)
 
     def __len__(self):
-        return 1 + ((len(self.data)-1) // self.seqlen.mu)
+        return math.ceil(max(0, len(self.data) - 1) / self.seqlen.mu)     # number of (input, target) batches
 
 
 class _LMLoaderIter(object):
@@ -111,7 +111,7 @@ class _LMLoaderIter(object):
         return self
 
     def __len__(self):
-        return 1 + ((len(self.lml.data)-1) // self.lml.seqlen.mu)
+        return math.ceil(max(0, len(self.lml.data) - 1) / self.lml.seqlen.mu)
 
     def __next__(self):
         if self.i < len(self.lml.data)-1:
@@ -129,14 +129,21 @@ class RNNLayer_LM(torch.nn.Module):
     encodertype = q.LSTMEncoder
 
     def __init__(self, *dims:int, worddic:dict=None, bias:bool=True, tieweights=False,
-                 dropout:float=0., dropouti:float=0., dropouth:float=0., dropoute:float=0., **kw):
+                 dropout:float=0., dropouti:float=0., dropouth:float=0., dropoute:float=0.,
+                 adaptive=False, counts=None, ret_hidden=False, **kw):
         super(RNNLayer_LM, self).__init__(**kw)
         self.dims = dims
         self.D = worddic
         self.states = None
+        self.ret_hidden = adaptive or ret_hidden     # if True, forward returns hidden states instead of output scores
         # make layers
         self.emb = q.WordEmb(dims[0], worddic=self.D)
-        self.out = q.WordLinout(dims[-1], worddic=self.D)
+        if adaptive:    # forward returns hidden states, to be used with q.AdaptiveCELoss(self.out)
+            if tieweights:
+                raise q.SumTingWongException("can't tie weights with adaptive softmax output")
+            self.out = q.AdaptiveWordLinout(dims[-1], worddic=self.D, counts=counts)
+        else:
+            self.out = q.WordLinout(dims[-1], worddic=self.D)
         if tieweights:
             self.out.weight = self.emb.weight
         self.rnn = self.encodertype(*dims, bidir=False, bias=bias, dropout_in=dropout)
@@ -161,7 +168,8 @@ class RNNLayer_LM(torch.nn.Module):
 
         # output
         out = self.dropout(out)
-        out = self.out(out)
+        if not self.ret_hidden:
+            out = self.out(out)
         return out
 
 
@@ -189,6 +197,8 @@ def run(lr=20.,
         seqlen=35,
         batsize=20,
         eval_batsize=80,
+        adaptive=False,
+        sampled=0,          # number of negative samples for sampled softmax training (0 = full softmax)
         cuda=False,
         gpu=0,
         test=False
@@ -207,7 +217,11 @@ def run(lr=20.,
     tt.tick("creating model")
     dims = [embdim] + ([encdim] * numlayers)
 
-    m = RNNLayer_LM(*dims, worddic=D, dropout=dropout, tieweights=tieweights).to(device)
+    counts = None
+    if adaptive or sampled > 0:
+        counts = torch.bincount(train_batches.data.view(-1), minlength=len(D)).numpy()
+    m = RNNLayer_LM(*dims, worddic=D, dropout=dropout, tieweights=tieweights,
+                    adaptive=adaptive, counts=counts, ret_hidden=sampled > 0).to(device)
 
     if test:
         for i, batch in enumerate(train_batches):
@@ -216,10 +230,16 @@ def run(lr=20.,
                 break
         print(y.size())
 
-    loss = q.LossWrapper(q.CELoss(mode="logits"))
-    validloss = q.LossWrapper(q.CELoss(mode="logits"))
+    if adaptive:
+        celoss = partial(q.AdaptiveCELoss, m.out)
+    elif sampled > 0:   # exact CE in eval mode
+        celoss = partial(q.SampledCELoss, m.out, counts, numsamples=sampled)
+    else:
+        celoss = partial(q.CELoss, mode="logits")
+    loss = q.LossWrapper(celoss())
+    validloss = q.LossWrapper(celoss())
     validlosses = [validloss, PPLfromCE(validloss)]
-    testloss = q.LossWrapper(q.CELoss(mode="logits"))
+    testloss = q.LossWrapper(celoss())
     testlosses = [testloss, PPLfromCE(testloss)]
 
     for l in [loss] + validlosses + testlosses:   # put losses on right device
@@ -98,7 +98,7 @@ class LMLoader(object):
         return _LMLoaderIter(self)
 
     def __len__(self):
-        return 1 + ((len(self.data)-1) // self.seqlen.mu)
+        return math.ceil(max(0, len(self.data) - 1) / self.seqlen.mu)     # number of (input, target) batches
 
 
 class _LMLoaderIter(object):
@@ -111,7 +111,7 @@ class _LMLoaderIter(object):
         return self
 
     def __len__(self):
-        return 1 + ((len(self.lml.data)-1) // self.lml.seqlen.mu)
+        return math.ceil(max(0, len(self.lml.data) - 1) / self.lml.seqlen.mu)
 
     def __next__(self):
         if self.i < len(self.lml.data)-1:
@@ -300,8 +300,8 @@ def run(lr=20.,
 
 def train_batch_distill(batch=None, model=None, optim=None, losses=None, device=torch.device("cpu"),
                 batch_number=-1, max_batches=0, current_epoch=0, max_epochs=0,
-                on_start=tuple(), on_before_optim_step=tuple(), on_after_optim_step=tuple(), on_end=tuple(), run=False,
-                mbase=None):
+                on_start=tuple(), on_before_optim_step=tuple(), on_after_optim_step=tuple(), on_end=tuple(),
+                print_every=1, accumulate=1, microbatch=None, autocast=False, profiler=None, run=False, mbase=None):
     """
     Runs a single batch of SGD on provided batch and settings.
     :param _batch:  batch to run on
@@ -323,6 +323,9 @@ def train_batch_distill(batch=None, model=None, optim=None, losses=None, device=
     #     kwargs = locals().copy()
     #     return partial(train_batch, **kwargs)
 
+    if accumulate != 1 or microbatch is not None:
+        raise q.SumTingWongException("gradient accumulation and micro-batching not supported for distillation")
+
     [e() for e in on_start]
     optim.zero_grad()
     model.train()
@@ -336,40 +339,48 @@ def train_batch_distill(batch=None, model=None, optim=None, losses=None, device=
     # run batch_in through teacher model to get teacher output distributions
     mbase.eval()
     q.batch_reset(mbase)
-    with torch.no_grad():
+    with torch.no_grad(), q.train._autocast(device, enabled=autocast):
         softgold = mbase(*batch_in)
 
     q.batch_reset(model)
-    modelouts = model(*batch_in)
+    with q.train._phase(profiler, "forward"), q.train._autocast(device, enabled=autocast):
+        modelouts = model(*batch_in)
 
     trainlosses = []
     for loss_obj in losses:
-        loss_val = loss_obj(modelouts, (softgold, gold))
+        with q.train._phase(profiler, "loss:" + loss_obj.name):
+            loss_val = loss_obj(modelouts, (softgold, gold))
         loss_val = [loss_val] if not q.issequence(loss_val) else loss_val
         trainlosses.extend(loss_val)
 
     cost = trainlosses[0]
-    cost.backward()
-
-    [e() for e in on_before_optim_step]
-    optim.step()
-    [e() for e in on_after_optim_step]
-
-    ttmsg = "train - Epoch {}/{} - [{}/{}]: {}".format(
-                current_epoch+1,
-                max_epochs,
-                batch_number+1,
-                max_batches,
-                q.pp_epoch_losses(*losses),
-                )
+    with q.train._phase(profiler, "backward"):
+        cost.backward()
+
+    with q.train._phase(profiler, "hooks"):
+        [e() for e in on_before_optim_step]
+    with q.train._phase(profiler, "optim"):
+        optim.step()
+    with q.train._phase(profiler, "hooks"):
+        [e() for e in on_after_optim_step]
+
+    ttmsg = None
+    if print_every <= 1 or (batch_number + 1) % print_every == 0 or batch_number + 1 == max_batches:
+        ttmsg = "train - Epoch {}/{} - [{}/{}]: {}".format(
+                    current_epoch+1,
+                    max_epochs,
+                    batch_number+1,
+                    max_batches,
+                    q.pp_epoch_losses(*losses),
+                    )
 
     [e() for e in on_end]
     return ttmsg
 
 
 def train_epoch_distill(model=None, dataloader=None, optim=None, losses=None, device=torch.device("cpu"), tt=q.ticktock("-"),
-             current_epoch=0, max_epochs=0, _train_batch=train_batch_distill, on_start=tuple(), on_end=tuple(), run=False,
-             mbase=None):
+             current_epoch=0, max_epochs=0, _train_batch=train_batch_distill, on_start=tuple(), on_end=tuple(),
+             print_every=1, accumulate=1, microbatch=None, autocast=False, profiler=None, run=False, mbase=None):
     """
     Performs an epoch of training on given model, with data from given dataloader, using given optimizer,
     with loss computed based on given losses.
@@ -399,11 +410,15 @@ def train_epoch_distill(model=None, dataloader=None, optim=None, losses=None, de
     q.epoch_reset(model)
     q.epoch_reset(mbase)
 
-    for i, _batch in enumerate(dataloader):
+    if profiler is not None:
+        profiler.start_epoch("train")
+    for i, _batch in enumerate(q.train._profile_iter(dataloader, profiler) if profiler is not None else dataloader):
         ttmsg = _train_batch(batch=_batch, model=model, optim=optim, losses=losses, device=device,
                              batch_number=i, max_batches=len(dataloader), current_epoch=current_epoch, max_epochs=max_epochs,
-                             run=True, mbase=mbase)
-        tt.live(ttmsg)
+                             print_every=print_every, accumulate=accumulate, microbatch=microbatch,
+                             autocast=autocast, profiler=profiler, run=True, mbase=mbase)
+        if ttmsg is not None:
+            tt.live(ttmsg)
 
     tt.stoplive()
     [e() for e in on_end]
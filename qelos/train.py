@@ -1,12 +1,16 @@
 import qelos as q
 import torch
 import numpy as np
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from IPython import embed
 from functools import partial
 
 
 __all__ = ["batch_reset", "epoch_reset", "LossWrapper", "BestSaver", "no_gold", "pp_epoch_losses",
-           "train_batch", "train_epoch", "test_epoch", "run_training"]
+           "StepProfiler", "ModuleProfiler", "train_batch", "train_epoch", "test_epoch", "run_training"]
 
 
 def batch_reset(module):        # performs all resetting operations on module before using it in the next batch
@@ -39,21 +43,17 @@ class LossWrapper(object):
         self.agg_history = []
         self.agg_epochs = []
 
-        self.epoch_agg_values = []
-        self.epoch_agg_sizes = []
+        # running sums for this epoch, kept on the device of the loss values (no sync until read)
+        self.epoch_agg_sum = 0.     # sum of loss values (weighted by sizes if mode is "mean")
+        self.epoch_agg_size = 0     # sum of sizes
 
     def get_epoch_error(self):
         """ returns the aggregated error for this epoch so far """
         if self.aggmode == "mean":
-            if len(self.epoch_agg_sizes) == 0:
-                ret = 0.
-            else:
-                total = sum(self.epoch_agg_sizes)
-                fractions = [x/total for x in self.epoch_agg_sizes]
-                parts = [x * y for x, y in zip(self.epoch_agg_values, fractions)]
-                ret = sum(parts)
+            total = float(self.epoch_agg_size)
+            ret = 0. if total == 0 else float(self.epoch_agg_sum) / total
         else:
-            ret = sum(self.epoch_agg_values)
+            ret = float(self.epoch_agg_sum)
         return ret
 
     def push_epoch_to_history(self, epoch=None):
@@ -62,6 +62,8 @@ class LossWrapper(object):
             self.agg_epochs.append(epoch)
 
     def __call__(self, pred, gold, **kw):
+        # (weight of loss value in loss value of whole batch, batch size) if pred and gold are a micro-batch of a batch
+        microbatch = q.getkw(kw, "microbatch", None)
         l = self.loss(pred, gold, **kw)
 
         numex = pred.size(0) if not q.issequence(pred) else pred[0].size(0)
@@ -69,11 +71,15 @@ class LossWrapper(object):
             numex = l[1]
             l = l[0]
         if isinstance(l, torch.Tensor):
-            lp = l.item()
+            lp = l.detach().double()
         else:
             lp = l
-        self.epoch_agg_values.append(lp)
-        self.epoch_agg_sizes.append(numex)
+        if microbatch is not None:      # aggregate as part of the whole batch's loss value
+            weight, batsize = microbatch
+            self.epoch_agg_sum = self.epoch_agg_sum + lp * weight * (batsize if self.aggmode == "mean" else 1)
+        else:
+            self.epoch_agg_sum = self.epoch_agg_sum + (lp * numex if self.aggmode == "mean" else lp)
+        self.epoch_agg_size = self.epoch_agg_size + numex
         return l
 
     def _reset(self):   # full reset
@@ -82,8 +88,8 @@ class LossWrapper(object):
         self.agg_epochs = []
 
     def reset_agg(self):    # reset epoch stats
-        self.epoch_agg_values = []
-        self.epoch_agg_sizes = []
+        self.epoch_agg_sum = 0.
+        self.epoch_agg_size = 0
 
 
 def no_gold(losses):
@@ -104,8 +110,314 @@ def pp_epoch_losses(*losses:LossWrapper):
     return ret
 
 
+class StepProfiler(object):
+    """
+    Times phases of training and testing steps (data fetch, device transfer, forward, losses, backward, hooks,
+    optimizer step) when passed to train_epoch/train_batch/test_epoch (and run_training for printing).
+    Durations are kept per epoch for every phase, separately for train and test epochs.
+    """
+    def __init__(self, sync=False, tracepath=None):
+        """
+        :param sync:        synchronize cuda at phase boundaries (accurate device times, but slower)
+        :param tracepath:   if given, every phase is also recorded as a Chrome trace event until .save_trace()
+        """
+        super(StepProfiler, self).__init__()
+        self.sync = sync and torch.cuda.is_available()
+        self.tracepath = tracepath
+        self.scope = ""
+        self.durations = OrderedDict()      # phase name -> list of durations (seconds) in current epoch
+        self.events = []                    # (scope, name, start, duration) if tracing, since last .save_trace()
+        self._tracescopes = []              # scopes in trace (thread ids)
+        self._tracefiles = {}               # path -> number of events saved in it
+        self._t0 = time.perf_counter()
+
+    def start_epoch(self, scope):
+        """ sets scope (e.g. "train" or "test") for next phases and clears previous durations in that scope """
+        self.scope = scope
+        for k in [k for k in self.durations if k[0] == scope]:
+            del self.durations[k]
+
+    def now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def record(self, name, start):
+        """ records phase with given name that started at start (from .now()) and ends now """
+        end = self.now()
+        self.durations.setdefault((self.scope, name), []).append(end - start)
+        if self.tracepath is not None:
+            self.events.append((self.scope, name, start, end - start))
+
+    @contextmanager
+    def phase(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def get_stats(self, scope=None):
+        """ returns {(scope, phase): {"total", "count", "mean", "p50", "p90", "p99"}} (seconds) for current epoch """
+        ret = OrderedDict()
+        for (scope_i, name), durations in self.durations.items():
+            if scope is None or scope_i == scope:
+                durations = np.asarray(durations)
+                p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+                ret[(scope_i, name)] = {"total": durations.sum(), "count": len(durations),
+                                        "mean": durations.mean(), "p50": p50, "p90": p90, "p99": p99}
+        return ret
+
+    def pp(self, scope=None):
+        """ one-line breakdown: share of total time, p50/p90 in ms for every phase """
+        stats = self.get_stats(scope)
+        parts = []
+        for scope_i in OrderedDict.fromkeys(k[0] for k in stats):
+            scopestats = [(name, v) for (s, name), v in stats.items() if s == scope_i]
+            total = sum(v["total"] for name, v in scopestats)
+            parts.append("{} [share p50/p90 ms]: ".format(scope_i) + " | ".join(
+                "{} {:.0%} {:.1f}/{:.1f}".format(name, v["total"] / total, v["p50"] * 1e3, v["p90"] * 1e3)
+                for name, v in scopestats))
+        return " -- ".join(parts)
+
+    def save_trace(self, path=None):
+        """ writes phases recorded since last save as Chrome trace JSON (chrome://tracing or ui.perfetto.dev)
+            and clears them. First save to a path overwrites the file, later saves append to it. """
+        path = path if path is not None else self.tracepath
+        events = []
+        for scope, name, start, duration in self.events:
+            if scope not in self._tracescopes:
+                self._tracescopes.append(scope)
+            events.append(json.dumps({"name": name, "cat": scope, "ph": "X", "pid": 0,
+                                      "tid": self._tracescopes.index(scope),
+                                      "ts": (start - self._t0) * 1e6, "dur": duration * 1e6}))
+        self.events = []
+        end = "\n]}\n".encode()
+        if path not in self._tracefiles:
+            with open(path, "wb") as f:
+                f.write(('{"displayTimeUnit": "ms", "traceEvents": [\n' + ",\n".join(events)).encode() + end)
+        elif len(events) > 0:     # overwrite end of file to keep it valid JSON
+            with open(path, "rb+") as f:
+                f.seek(-len(end), 2)
+                f.write((",\n" if self._tracefiles[path] > 0 else "").encode()
+                        + ",\n".join(events).encode() + end)
+        self._tracefiles[path] = self._tracefiles.get(path, 0) + len(events)
+
+
+def _tensor_bytes(x):
+    if isinstance(x, torch.Tensor):
+        return x.numel() * x.element_size()
+    elif isinstance(x, (list, tuple)):
+        return sum(_tensor_bytes(xe) for xe in x)
+    elif isinstance(x, dict):
+        return sum(_tensor_bytes(xe) for xe in x.values())
+    return 0
+
+
+def _map_tensors(x, f):
+    """ applies f to all tensors in (nested tuples, lists, dicts and PackedSequences) x """
+    if isinstance(x, torch.nn.utils.rnn.PackedSequence):
+        return x._replace(data=_map_tensors(x.data, f))
+    elif isinstance(x, torch.Tensor):
+        return f(x)
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_map_tensors(xe, f) for xe in x)
+    elif isinstance(x, dict):
+        return type(x)((k, _map_tensors(v, f)) for k, v in x.items())
+    return x
+
+
+class _BackwardMarker(torch.autograd.Function):
+    """ identity on given tensors, calls callback in backward, once the gradients of all of them are available """
+    @staticmethod
+    def forward(ctx, callback, *tensors):
+        ctx.callback = callback
+        return tensors
+
+    @staticmethod
+    def backward(ctx, *grads):
+        ctx.callback()
+        return (None,) + grads
+
+
+def _mark_backward(x, callback):
+    """ passes the tensors in x that require grad through a _BackwardMarker calling callback
+        :return:    x with marked tensors, or x as is if no tensor requires grad """
+    tensors = []
+    _map_tensors(x, lambda t: tensors.append(t) if t.requires_grad else None)
+    if len(tensors) == 0 or not torch.is_grad_enabled():
+        return x
+    marked = iter(_BackwardMarker.apply(callback, *tensors))
+    return _map_tensors(x, lambda t: next(marked) if t.requires_grad else t)
+
+
+class ModuleProfiler(object):
+    """
+    Accumulates wall time, call counts and output tensor bytes of the forward (and backward) passes
+    of every submodule of a model (by module path, e.g. "dec.layers.0.slf_attn"), using hooks.
+    Time of a module includes the time of its submodules.
+    If backward is True, backward time of a module call is measured from when the gradient of one of its outputs
+    is available (hooks on the autograd nodes of the outputs) until the gradients of all its inputs are computed
+    (inputs, also in PackedSequences, are passed through an identity autograd function).
+    This is not possible for modules without inputs that require grad (e.g. embedders of ids)
+    and isn't done for modules containing in-place modules (e.g. ReLU(inplace=True)), because the marked inputs
+    can't be modified in-place: their backward time is the sum of their children's, or shown as "n/a" if there is none.
+    Other in-place modifications of module inputs (e.g. "x += y" in a forward) fail when timing backward.
+    Hooks are only attached while enabled, so there is no cost when disabled:
+        prof = q.ModuleProfiler(model)
+        with prof:      # or prof.enable() ... prof.disable()
+            q.train_epoch(...)
+        print(prof.report())
+    """
+    def __init__(self, model, backward=False, sync=False):
+        """
+        :param model:       model whose submodules will be timed
+        :param backward:    also time backward passes of modules (see above)
+        :param sync:        synchronize cuda before taking times (accurate device times, but slower)
+        """
+        super(ModuleProfiler, self).__init__()
+        self.model, self.backward, self.sync = model, backward, sync and torch.cuda.is_available()
+        self.paths = OrderedDict((module, path) for path, module in model.named_modules())
+        # modules whose inputs are marked for timing backward (not if they might modify them in-place)
+        self._mark_inputs = {module: not any(getattr(m, "inplace", False) for m in module.modules())
+                             for module in self.paths}
+        self._handles = []
+        self._calls = {}        # module -> stack of [forward start, backward start] of running forward calls
+        self.reset()
+
+    def reset(self):
+        # path -> [forward time, forward calls, output bytes, backward time, backward calls]
+        self.stats = OrderedDict((path, [0., 0, 0, 0., 0]) for path in self.paths.values())
+
+    @property
+    def enabled(self):
+        return len(self._handles) > 0
+
+    def enable(self):
+        if self.enabled:
+            return self
+        for module in self.paths:
+            self._handles.append(module.register_forward_pre_hook(self._fwd_pre_hook))
+            self._handles.append(module.register_forward_hook(self._fwd_hook))
+        return self
+
+    def disable(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._calls = {}
+        return self
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *args):
+        self.disable()
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _fwd_pre_hook(self, module, inputs):
+        call = [None, None]
+        self._calls.setdefault(module, []).append(call)
+        if self.backward and self._mark_inputs[module]:
+            inputs = _mark_backward(inputs, partial(self._bwd_end, self.stats[self.paths[module]], call))
+        call[0] = self._now()
+        return inputs
+
+    def _fwd_hook(self, module, inputs, outputs):
+        call = self._calls[module].pop()
+        stats = self.stats[self.paths[module]]
+        stats[0] += self._now() - call[0]
+        stats[1] += 1
+        stats[2] += _tensor_bytes(outputs)
+        if self.backward and self._mark_inputs[module] and torch.is_grad_enabled():
+            nodes = []
+            _map_tensors(outputs, lambda t: nodes.append(t.grad_fn) if t.grad_fn is not None else None)
+            for node in set(nodes):     # outputs aren't replaced, so they can still be modified in-place
+                node.register_prehook(partial(self._bwd_start, call))
+
+    def _bwd_start(self, call, grad_outputs):
+        if call[1] is None:     # first output gradient
+            call[1] = self._now()
+
+    def _bwd_end(self, stats, call):
+        if call[1] is not None:     # None if no output of the module was used
+            stats[3] += self._now() - call[1]
+            stats[4] += 1
+            call[1] = None
+
+    def report(self, maxdepth=None, mintime=0.):
+        """
+        :param maxdepth:    (optional) maximum depth of modules to show
+        :param mintime:     don't show modules with less total (forward + backward) time (in seconds)
+        :return:            tree of modules (children sorted by total time) with time in forward and backward (ms),
+                            share of total model time, number of forward calls and total output size (MB)
+        """
+        children = OrderedDict((path, []) for path in self.stats)
+        for path in self.stats:
+            if path != "":
+                children[path.rsplit(".", 1)[0] if "." in path else ""].append(path)
+        # modules that aren't called themselves (e.g. ModuleList) or whose backward isn't measured
+        # get the sum of their children (None for backward if nothing is measured)
+        times = {}
+
+        def collect(path):
+            fwd, bwd = self.stats[path][0], self.stats[path][3] if self.stats[path][4] > 0 else None
+            childtimes = [collect(child) for child in children[path]]
+            childbwds = [t[1] for t in childtimes if t[1] is not None]
+            if len(childbwds) > 0:
+                bwd = max(bwd or 0., sum(childbwds))
+            times[path] = (max(fwd, sum(t[0] for t in childtimes)), bwd)
+            return times[path]
+        collect("")
+        total_of = lambda path: times[path][0] + (times[path][1] or 0.)
+        roottotal = max(total_of(""), 1e-12)
+        lines = ["{:<50} {:>10} {:>10} {:>6} {:>7} {:>9}".format("module", "fwd ms", "bwd ms", "share", "calls", "out MB")]
+
+        def rec(path, depth):
+            calls, outbytes = self.stats[path][1], self.stats[path][2]
+            name = path.rsplit(".", 1)[-1] if path != "" else "(model)"
+            name = "{}{} ({})".format("  " * depth, name, type(self.model.get_submodule(path)).__name__)
+            bwd = "{:.2f}".format(times[path][1] * 1e3) if times[path][1] is not None else "n/a"
+            lines.append("{:<50} {:>10.2f} {:>10} {:>6.1%} {:>7} {:>9.2f}"
+                         .format(name, times[path][0] * 1e3, bwd, total_of(path) / roottotal, calls, outbytes / 2**20))
+            if maxdepth is None or depth < maxdepth:
+                for child in sorted(children[path], key=total_of, reverse=True):
+                    if total_of(child) > 0 and total_of(child) >= mintime:
+                        rec(child, depth + 1)
+        rec("", 0)
+        return "\n".join(lines)
+
+
+def _phase(profiler, name):
+    return profiler.phase(name) if profiler is not None else nullcontext()
+
+
+def _profile_iter(iterable, profiler, name="data"):
+    """ iterates over iterable, recording the time to get every element in profiler """
+    it = iter(iterable)
+    while True:
+        start = profiler.now()
+        try:
+            x = next(it)
+        except StopIteration:
+            return
+        profiler.record(name, start)
+        yield x
+
+
 # region loops
-def eval_loop(model, dataloader, device=torch.device("cpu")):
+def _autocast(device, enabled=True):
+    """ bfloat16 autocast context for forward passes on given device """
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def eval_loop(model, dataloader, device=torch.device("cpu"), autocast=False):
+    """ Runs model on all batches from dataloader and concatenates outputs.
+        If autocast=True, runs model under bfloat16 autocast (floating point outputs are returned in float32). """
     tto = q.ticktock("testing")
     tto.tick("testing")
     tt = q.ticktock("-")
@@ -119,7 +431,10 @@ def eval_loop(model, dataloader, device=torch.device("cpu")):
             batch = q.recmap(batch, lambda x: x.to(device) if isinstance(x, torch.Tensor) else x)
 
             batch_reset(model)
-            modelouts = model(*batch)
+            with _autocast(device, enabled=autocast):
+                modelouts = model(*batch)
+            if autocast and modelouts.is_floating_point():
+                modelouts = modelouts.float()
 
             tt.live("eval - [{}/{}]"
                 .format(
@@ -138,7 +453,8 @@ def eval_loop(model, dataloader, device=torch.device("cpu")):
 
 def train_batch(batch=None, model=None, optim=None, losses=None, device=torch.device("cpu"),
                 batch_number=-1, max_batches=0, current_epoch=0, max_epochs=0,
-                on_start=tuple(), on_before_optim_step=tuple(), on_after_optim_step=tuple(), on_end=tuple(), run=False):
+                on_start=tuple(), on_before_optim_step=tuple(), on_after_optim_step=tuple(), on_end=tuple(),
+                print_every=1, accumulate=1, microbatch=None, autocast=False, profiler=None, flush=0, run=False):
     """
     Runs a single batch of SGD on provided batch and settings.
     :param batch:  batch to run on
@@ -154,61 +470,192 @@ def train_batch(batch=None, model=None, optim=None, losses=None, device=torch.de
     :param on_before_optim_step:    collection of functions for before optimization step is taken (gradclip)
     :param on_after_optim_step:     collection of functions for after optimization step is taken
     :param on_end:              collection of functions to call when batch is done
+    :param print_every:         only return a progress message (and check cost for NaN) every print_every batches
+                                and on the last batch. Otherwise, returns None and doesn't wait for the device.
+    :param accumulate:          accumulate gradients over this many consecutive batches (by batch_number)
+                                and only take an optimization step (and call on_*_optim_step) after the last one.
+                                Costs are divided by accumulate. The last (incomplete) window of an epoch
+                                must be finished with flush.
+    :param microbatch:          if set, batch is split along dim 0 in micro-batches of at most this many examples,
+                                which are run and backpropagated one by one. Costs are weighted by their share
+                                in the whole batch's cost (see _microbatch_weights()), so gradients and epoch losses
+                                are those of the whole batch.
+                                Model state across micro-batches (other than batch_reset()) is not supported.
+    :param autocast:            if True, runs model forward under bfloat16 autocast.
+                                Losses are computed outside autocast (CELoss etc. compute in float32).
+    :param profiler:            (optional) q.StepProfiler to record time spent in transfer, forward, every loss,
+                                backward, hooks and optimizer step
+    :param flush:               if > 0, no batch is run. Instead, the gradients accumulated over the last flush batches
+                                (an incomplete window of accumulate batches) are rescaled to their mean
+                                and an optimization step is taken.
     :return:
     """
     # if run is False:
     #     kwargs = locals().copy()
     #     return partial(train_batch, **kwargs)
 
+    if flush > 0:
+        for param in model.parameters():
+            if param.grad is not None:
+                param.grad.mul_(accumulate / flush)
+        _optim_step(optim, on_before_optim_step, on_after_optim_step, profiler)
+        optim.zero_grad()
+        return None
+
     [e() for e in on_start]
-    optim.zero_grad()
+    windowsize, first_in_window, last_in_window = 1, True, True
+    if accumulate > 1 and batch_number >= 0:     # windows by batch number, so independent of len(dataloader)
+        windowsize = accumulate
+        first_in_window = batch_number % accumulate == 0
+        last_in_window = (batch_number + 1) % accumulate == 0
+
+    if first_in_window:
+        optim.zero_grad()
     model.train()
 
     batch = (batch,) if not q.issequence(batch) else batch
-    batch = q.recmap(batch, lambda x: x.to(device) if isinstance(x, torch.Tensor) else x)
-
-    if q.no_gold(losses):
-        batch_in = batch
-        gold = None
-    else:
-        batch_in = batch[:-1]
-        gold = batch[-1]
+    with _phase(profiler, "transfer"):
+        batch = q.recmap(batch, lambda x: x.to(device) if isinstance(x, torch.Tensor) else x)
 
+    do_print = _is_print_batch(batch_number, max_batches, print_every)
     q.batch_reset(model)
-    modelouts = model(*batch_in)
+    microbatches = _split_batch(batch, microbatch)
+    weights = None      # for every loss, weight of every micro-batch's loss value in the whole batch's loss value
+    if len(microbatches) > 1:
+        weights = _microbatch_weights(losses, microbatches, has_gold=not q.no_gold(losses))
+        batsize = sum(_batch_size(batch_i) for batch_i, _ in microbatches)
+    for i, (batch_i, fraction) in enumerate(microbatches):
+        if weights is not None and weights[0][i] == 0:      # nothing counted in this micro-batch
+            continue
+        if q.no_gold(losses):
+            batch_in = batch_i
+            gold = None
+        else:
+            batch_in = batch_i[:-1]
+            gold = batch_i[-1]
 
-    trainlosses = []
-    for loss_obj in losses:
-        loss_val = loss_obj(modelouts, gold)
-        loss_val = [loss_val] if not q.issequence(loss_val) else loss_val
-        trainlosses.extend(loss_val)
+        with _phase(profiler, "forward"), _autocast(device, enabled=autocast):
+            modelouts = model(*batch_in)
 
-    cost = trainlosses[0]
+        trainlosses = []
+        for j, loss_obj in enumerate(losses):
+            with _phase(profiler, "loss:" + loss_obj.name):
+                if weights is None:
+                    loss_val = loss_obj(modelouts, gold)
+                else:
+                    loss_val = loss_obj(modelouts, gold, microbatch=(weights[j][i], batsize))
+            loss_val = [loss_val] if not q.issequence(loss_val) else loss_val
+            trainlosses.extend(loss_val)
+
+        cost = trainlosses[0]
+
+        if do_print and torch.isnan(cost).any():
+            print("Cost is NaN!")
+            embed()
+
+        weight = weights[0][i] if weights is not None else 1
+        if weight != 1 or windowsize != 1:
+            cost = cost * (weight / windowsize)
+        with _phase(profiler, "backward"):
+            cost.backward()
+
+    if last_in_window:
+        _optim_step(optim, on_before_optim_step, on_after_optim_step, profiler)
+
+    ttmsg = None
+    if do_print:
+        ttmsg = "train - Epoch {}/{} - [{}/{}]: {}".format(
+                    current_epoch+1,
+                    max_epochs,
+                    batch_number+1,
+                    max_batches,
+                    q.pp_epoch_losses(*losses),
+                    )
 
-    if torch.isnan(cost).any():
-        print("Cost is NaN!")
-        embed()
+    [e() for e in on_end]
+    return ttmsg
 
-    cost.backward()
 
-    [e() for e in on_before_optim_step]
-    optim.step()
-    [e() for e in on_after_optim_step]
+def _optim_step(optim, on_before_optim_step, on_after_optim_step, profiler=None):
+    with _phase(profiler, "hooks"):
+        [e() for e in on_before_optim_step]
+    with _phase(profiler, "optim"):
+        optim.step()
+    with _phase(profiler, "hooks"):
+        [e() for e in on_after_optim_step]
 
-    ttmsg = "train - Epoch {}/{} - [{}/{}]: {}".format(
-                current_epoch+1,
-                max_epochs,
-                batch_number+1,
-                max_batches,
-                q.pp_epoch_losses(*losses),
-                )
 
-    [e() for e in on_end]
-    return ttmsg
+def _slice_batch(x, start, end, batsize):
+    """ slices all tensors in (nested) x with batsize examples along dim 0 (without modifying x) """
+    if isinstance(x, (list, tuple)):
+        return type(x)(_slice_batch(xe, start, end, batsize) for xe in x)
+    elif isinstance(x, dict):
+        return {k: _slice_batch(v, start, end, batsize) for k, v in x.items()}
+    elif isinstance(x, torch.Tensor) and x.dim() > 0 and x.size(0) == batsize:
+        return x[start:end]
+    else:
+        return x
+
+
+def _split_batch(batch, size=None):
+    """ splits batch in micro-batches of at most size examples, returns list of (micro-batch, fraction of batch) """
+    sizes = [x.size(0) for x in batch if isinstance(x, torch.Tensor) and x.dim() > 0]
+    if size is None or len(sizes) == 0 or sizes[0] <= size:
+        return [(batch, 1)]
+    batsize = sizes[0]
+    return [(_slice_batch(batch, i, min(i + size, batsize), batsize), (min(i + size, batsize) - i) / batsize)
+            for i in range(0, batsize, size)]
+
+
+def _batch_size(batch):
+    return [x.size(0) for x in batch if isinstance(x, torch.Tensor) and x.dim() > 0][0]
+
+
+def _loss_reduction(loss):
+    """ :return: how loss reduces over elements ("mean" or "sum", None if unknown) and the gold ids it ignores """
+    if isinstance(loss, q.CELoss):
+        loss = loss.ce
+    if isinstance(loss, q.loss.DiscreteLoss):     # averages over examples
+        return ("mean" if loss.size_average else "sum"), None
+    if getattr(loss, "weight", None) is not None:     # class weights: mean is weighted by gold classes
+        return None, None
+    reduction = getattr(loss, "reduction", "elementwise_mean")
+    reduction = {"elementwise_mean": "mean", "mean": "mean", "sum": "sum"}.get(reduction, None)
+    ignore_indices = getattr(loss, "ignore_indices", getattr(loss, "ignore_index", None))
+    return reduction, ignore_indices
+
+
+def _microbatch_weights(losses, microbatches, has_gold=True):
+    """ For every loss, the weight of every micro-batch's loss value in the loss value of the whole batch:
+        1 for summed losses, the share of examples for mean losses, or the share of elements that aren't ignored
+        for mean losses with ignored gold ids. Losses without ignored ids or "reduction" are assumed to be means over examples.
+        Only counting elements waits for the device (once per batch). """
+    fractions = [fraction for _, fraction in microbatches]
+    ret = []
+    for loss_obj in losses:
+        reduction, ignore_indices = _loss_reduction(loss_obj.loss)
+        if reduction is None:
+            raise q.SumTingWongException("micro-batching not supported for loss {}".format(loss_obj.name))
+        elif reduction == "sum":
+            ret.append([1.] * len(microbatches))
+        elif ignore_indices is None or not has_gold:
+            ret.append(fractions)
+        else:
+            golds = [batch_i[-1] for batch_i, _ in microbatches]
+            golds = [gold[-1] if q.issequence(gold) else gold for gold in golds]    # e.g. (soft gold, hard gold)
+            counts = torch.stack([q.loss.DiscreteLoss.get_ignore_mask(gold, ignore_indices).sum() for gold in golds])
+            total = counts.sum()
+            ret.append((counts.double() / total).tolist() if total > 0 else fractions)
+    return ret
+
+
+def _is_print_batch(batch_number, max_batches, print_every):
+    return print_every <= 1 or (batch_number + 1) % print_every == 0 or batch_number + 1 == max_batches
 
 
 def train_epoch(model=None, dataloader=None, optim=None, losses=None, device=torch.device("cpu"), tt=q.ticktock("-"),
-             current_epoch=0, max_epochs=0, _train_batch=train_batch, on_start=tuple(), on_end=tuple(), run=False):
+             current_epoch=0, max_epochs=0, _train_batch=train_batch, on_start=tuple(), on_end=tuple(), prefetch=0,
+             print_every=1, accumulate=1, microbatch=None, autocast=False, profiler=None, run=False):
     """
     Performs an epoch of training on given model, with data from given dataloader, using given optimizer,
     with loss computed based on given losses.
@@ -223,12 +670,22 @@ def train_epoch(model=None, dataloader=None, optim=None, losses=None, device=tor
     :param _train_batch:    train batch function, default is train_batch
     :param on_start:
     :param on_end:
+    :param prefetch:    if > 0, batches are prepared and moved to device in background (queue depth prefetch).
+                        dataloader can also be a q.BatchPrefetcher.
+    :param print_every: update progress (reads losses from device) every print_every batches
+    :param accumulate:  number of batches to accumulate gradients over per optimization step, see train_batch
+    :param microbatch:  maximum number of examples per forward/backward pass, see train_batch
+    :param autocast:    run model forward under bfloat16 autocast, see train_batch
+    :param profiler:    (optional) q.StepProfiler to record time spent in data fetching and phases of train_batch
     :return:
     """
     # if run is False:
     #     kwargs = locals().copy()
     #     return partial(train_epoch, **kwargs)
 
+    if prefetch > 0:
+        dataloader = q.BatchPrefetcher(dataloader, device=device, depth=prefetch)
+
     for loss in losses:
         loss.push_epoch_to_history(epoch=current_epoch-1)
         loss.reset_agg()
@@ -237,21 +694,33 @@ def train_epoch(model=None, dataloader=None, optim=None, losses=None, device=tor
 
     q.epoch_reset(model)
 
-    for i, _batch in enumerate(dataloader):
+    if profiler is not None:
+        profiler.start_epoch("train")
+    numbatches = 0
+    for i, _batch in enumerate(_profile_iter(dataloader, profiler) if profiler is not None else dataloader):
         ttmsg = _train_batch(batch=_batch, model=model, optim=optim, losses=losses, device=device,
                              batch_number=i, max_batches=len(dataloader), current_epoch=current_epoch, max_epochs=max_epochs,
-                             run=True)
-        tt.live(ttmsg)
+                             print_every=print_every, accumulate=accumulate, microbatch=microbatch,
+                             autocast=autocast, profiler=profiler, run=True)
+        numbatches = i + 1
+        if ttmsg is not None:
+            tt.live(ttmsg)
+    if accumulate > 1 and numbatches % accumulate > 0:    # step on gradients of last incomplete window
+        _train_batch(model=model, optim=optim, losses=losses, device=device, accumulate=accumulate,
+                     profiler=profiler, flush=numbatches % accumulate, run=True)
 
     tt.stoplive()
     [e() for e in on_end]
     ttmsg = q.pp_epoch_losses(*losses)
+    if isinstance(dataloader, q.BatchPrefetcher):
+        ttmsg += " ({})".format(dataloader.pp_stalls())
     return ttmsg
 
 
 def test_epoch(model=None, dataloader=None, losses=None, device=torch.device("cpu"),
             current_epoch=0, max_epochs=0,
-            on_start=tuple(), on_start_batch=tuple(), on_end_batch=tuple(), on_end=tuple(), run=False):
+            on_start=tuple(), on_start_batch=tuple(), on_end_batch=tuple(), on_end=tuple(), prefetch=0,
+            print_every=1, autocast=False, profiler=None, run=False):
     """
     Performs a test epoch. If run=True, runs, otherwise returns partially filled function.
     :param model:
@@ -264,12 +733,19 @@ def test_epoch(model=None, dataloader=None, losses=None, device=torch.device("cp
     :param on_start_batch:
     :param on_end_batch:
     :param on_end:
+    :param prefetch:    if > 0, batches are prepared and moved to device in background (queue depth prefetch)
+    :param print_every: update progress (reads losses from device) every print_every batches
+    :param autocast:    if True, runs model forward under bfloat16 autocast (losses outside)
+    :param profiler:    (optional) q.StepProfiler to record time spent in data fetching, transfer, forward and losses
     :return:
     """
     # if run is False:
     #     kwargs = locals().copy()
     #     return partial(test_epoch, **kwargs)
 
+    if prefetch > 0:
+        dataloader = q.BatchPrefetcher(dataloader, device=device, depth=prefetch)
+
     tt = q.ticktock("-")
     model.eval()
     q.epoch_reset(model)
@@ -278,11 +754,14 @@ def test_epoch(model=None, dataloader=None, losses=None, device=torch.device("cp
         for loss_obj in losses:
             loss_obj.push_epoch_to_history()
             loss_obj.reset_agg()
-        for i, _batch in enumerate(dataloader):
+        if profiler is not None:
+            profiler.start_epoch("test")
+        for i, _batch in enumerate(_profile_iter(dataloader, profiler) if profiler is not None else dataloader):
             [e() for e in on_start_batch]
 
             _batch = (_batch,) if not q.issequence(_batch) else _batch
-            _batch = q.recmap(_batch, lambda x: x.to(device) if isinstance(x, torch.Tensor) else x)
+            with _phase(profiler, "transfer"):
+                _batch = q.recmap(_batch, lambda x: x.to(device) if isinstance(x, torch.Tensor) else x)
             batch = _batch
 
             if no_gold(losses):
@@ -293,31 +772,36 @@ def test_epoch(model=None, dataloader=None, losses=None, device=torch.device("cp
                 gold = batch[-1]
 
             q.batch_reset(model)
-            modelouts = model(*batch_in)
+            with _phase(profiler, "forward"), _autocast(device, enabled=autocast):
+                modelouts = model(*batch_in)
 
             testlosses = []
             for loss_obj in losses:
-                loss_val = loss_obj(modelouts, gold)
+                with _phase(profiler, "loss:" + loss_obj.name):
+                    loss_val = loss_obj(modelouts, gold)
                 loss_val = [loss_val] if not q.issequence(loss_val) else loss_val
                 testlosses.extend(loss_val)
 
-            tt.live("test - Epoch {}/{} - [{}/{}]: {}".format(
-                current_epoch + 1,
-                max_epochs,
-                i + 1,
-                len(dataloader),
-                q.pp_epoch_losses(*losses)
-            )
-            )
+            if _is_print_batch(i, len(dataloader), print_every):
+                tt.live("test - Epoch {}/{} - [{}/{}]: {}".format(
+                    current_epoch + 1,
+                    max_epochs,
+                    i + 1,
+                    len(dataloader),
+                    q.pp_epoch_losses(*losses)
+                )
+                )
             [e() for e in on_end_batch]
     tt.stoplive()
     [e() for e in on_end]
     ttmsg = q.pp_epoch_losses(*losses)
+    if isinstance(dataloader, q.BatchPrefetcher):
+        ttmsg += " ({})".format(dataloader.pp_stalls())
     return ttmsg
 
 
 def run_training(run_train_epoch=None, run_valid_epoch=None, max_epochs=1, validinter=1,
-                 print_on_valid_only=False):
+                 print_on_valid_only=False, profiler=None):
     """
 
     :param run_train_epoch:     function that performs an epoch of training. must accept current_epoch and max_epochs. Tip: use functools.partial
@@ -325,6 +809,8 @@ def run_training(run_train_epoch=None, run_valid_epoch=None, max_epochs=1, valid
     :param max_epochs:
     :param validinter:
     :param print_on_valid_only:
+    :param profiler:    q.StepProfiler also given to the epoch functions, breakdown is printed after every epoch
+                        (and new trace events are appended to its tracepath if it has one)
     :return:
     """
     tt = q.ticktock("runner")
@@ -343,6 +829,10 @@ def run_training(run_train_epoch=None, run_valid_epoch=None, max_epochs=1, valid
         validinter_count += 1
         if not print_on_valid_only or validepoch:
             tt.tock(ttmsg)
+            if profiler is not None:
+                tt.msg(profiler.pp() if validepoch else profiler.pp("train"))
+        if profiler is not None and profiler.tracepath is not None:
+            profiler.save_trace()
         current_epoch += 1
         stop_training = current_epoch >= max_epochs
 
@@ -198,10 +198,10 @@ class MultiHeadAttention(nn.Module):
         wholemask = None
         if mask is not None:
             # w = w + torch.log(mask.float().view(mask.size(0), 1, mask.size(1), 1))
-            wholemask = mask.float().view(mask.size(0), 1, 1, mask.size(1))
+            wholemask = mask.to(w.dtype).view(mask.size(0), 1, 1, mask.size(1))
         if self.bidir is False:
             seqlen = w.size(-1)
-            causality_mask = torch.tril(torch.ones(seqlen, seqlen, device=x.device)).unsqueeze(0).unsqueeze(0)
+            causality_mask = torch.tril(torch.ones(seqlen, seqlen, device=x.device, dtype=w.dtype)).unsqueeze(0).unsqueeze(0)
             if q.size(1) < causality_mask.size(2):  # right-align q's (for cell mode)
                 causality_mask = causality_mask[:, :, -q.size(1):, :]
                 # .view(1, 1, seqlen, seqlen)
@@ -276,7 +276,7 @@ class TransformerEncoderBlock(nn.Module):
 
     def forward(self, x, mask=None):
         if mask is not None:
-            x = x * mask.float().unsqueeze(-1)
+            x = x * mask.to(x.dtype).unsqueeze(-1)
         # a = self.slf_attn(x, mask=mask)
         # h = self.mlp(a+x) + x
         #
@@ -315,7 +315,7 @@ class TransformerDecoderBlock(TransformerEncoderBlock):
         :return:
         """
         if mask is not None:
-            x = x * mask.float().unsqueeze(-1)
+            x = x * mask.to(x.dtype).unsqueeze(-1)
         # if ctxmask is not None:
         #     ctx = ctx * ctxmask.float().unsqueeze(-1)     # do we need this? no
         # self attention
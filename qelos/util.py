@@ -1,12 +1,21 @@
 import argparse
+import array
 import collections
+import functools
+import hashlib
 import inspect
+import itertools
 import re
 import os
+import multiprocessing
 import signal
 import sys
 from datetime import datetime as dt
 import pickle
+import queue
+import threading
+import time
+import types
 import nltk
 import traceback
 from copy import deepcopy as deepcopy
@@ -21,9 +30,10 @@ from torch.utils.data import Dataset, DataLoader
 
 
 __all__ = ["ticktock", "argprun", "deep_copy", "copy_params", "seq_pack", "seq_unpack", "iscuda", "hyperparam", "v",
-           "intercat", "masked_mean", "tensor_dataset", "datacat", "dataload", "datasplit",
+           "intercat", "masked_mean", "tensor_dataset", "datacat", "fetch_batch", "dataload", "BucketedBatchSampler",
+           "datasplit", "IndexedDataset",
            "iscallable", "isfunction", "getnumargs", "getkw", "issequence", "iscollection", "isnumber", "isstring",
-           "StringMatrix", "tokenize", "recmap", "inf_batches"]
+           "StringMatrix", "tokenize", "Tokenizer", "recmap", "inf_batches", "BatchPrefetcher"]
 
 # region torch-related utils
 def copy_params(source, target):
@@ -51,44 +61,31 @@ def deep_copy(source, share_params=False):
 # SEQUENCE PACKING AND UNPACKING
 def seq_pack(x, mask, ret_sorter=False):  # mask: (batsize, seqlen)
     """ given N-dim sequence "x" (N>=2), and 2D mask (batsize, seqlen)
-        returns packed sequence (sorted) and indexes to un-sort (also used by seq_unpack) """
-    x = x.float()
-    mask = mask.float()
-    # 1. get lengths
-    lens = torch.sum(mask.float(), 1)
-    # 2. sort by length
+        returns packed sequence and indexes to un-sort (unsorter, also stored in the packed sequence)
+        and, if ret_sorter, the indexes used to sort by length.
+        x keeps its dtype. The packed sequence carries its sort/unsort indexes, so torch RNN layers
+        take care of sorting initial states and un-sorting final states, and seq_unpack() returns original order.
+        Only the lengths are moved to cpu (required by pack_padded_sequence). """
+    lens = mask.long().sum(1)
     assert(lens.dim() == 1)
-    _, sortidxs = torch.sort(lens, descending=True)
-    unsorter = torch.zeros(sortidxs.size()).to(sortidxs.device).long()
-    # print ("test unsorter")
-    # print (unsorter)
-    unsorter.scatter_(0, sortidxs,
-           torch.arange(0, len(unsorter), dtype=torch.int64, device=sortidxs.device))
-    # 3. pack
-    sortedseq = torch.index_select(x, 0, sortidxs)
-    sortedmsk = torch.index_select(mask, 0, sortidxs)
-    sortedlens = sortedmsk.long().sum(1)
-    sortedlens = list(sortedlens.cpu().detach().numpy())
-    packedseq = torch.nn.utils.rnn.pack_padded_sequence(sortedseq, sortedlens, batch_first=True)
-
-    # 4. return
+    packedseq = torch.nn.utils.rnn.pack_padded_sequence(x, lens.cpu(), batch_first=True, enforce_sorted=False)
     if ret_sorter:
-        return packedseq, unsorter, sortidxs
+        return packedseq, packedseq.unsorted_indices, packedseq.sorted_indices
     else:
-        return packedseq, unsorter
+        return packedseq, packedseq.unsorted_indices
 
 
-def seq_unpack(x, order, padding_value=0):
-    """ given packed sequence "x" and the un-sorter "order",
-        returns padded sequence (un-sorted by "order") and a binary 2D mask (batsize, seqlen),
+def seq_unpack(x, order=None, padding_value=0):
+    """ given packed sequence "x" (and the un-sorter "order" if x doesn't carry its own unsorted_indices),
+        returns padded sequence (in original order) and a binary 2D mask (batsize, seqlen),
             where padded sequence is padded with "padding_value" """
     unpacked, lens = torch.nn.utils.rnn.pad_packed_sequence(x, batch_first=True, padding_value=padding_value)
-    mask = torch.zeros(len(lens), max(lens), dtype=torch.int64, device=unpacked.device)
-    for i, l in enumerate(lens):
-        mask[i, :l] = 1
-    out = torch.index_select(unpacked, 0, order)        # same as: unpacked[order]
-    outmask = torch.index_select(mask, 0, order)        # same as: mask[order]
-    return out, outmask
+    lens = lens.to(unpacked.device)
+    mask = (torch.arange(unpacked.size(1), device=unpacked.device)[None, :] < lens[:, None]).long()
+    if x.unsorted_indices is None and order is not None:    # pad_packed_sequence has un-sorted already otherwise
+        unpacked = torch.index_select(unpacked, 0, order)   # same as: unpacked[order]
+        mask = torch.index_select(mask, 0, order)           # same as: mask[order]
+    return unpacked, mask
 
 
 def iscuda(x):
@@ -154,25 +151,27 @@ def masked_mean(x, dim=None, mask=None, keepdim=False):
     if mask is None:
         return torch.mean(x, dim, keepdim=keepdim)
     else:
-        mask = mask.float()
-        x = x * mask
-        x_sum = torch.sum(x, dim, keepdim=keepdim)
+        mask = mask.float()     # sums and division in float32 (counts aren't exact in reduced precision)
+        x_sum = torch.sum(x.float() * mask, dim, keepdim=keepdim)
         mask_sum = torch.sum(mask, dim, keepdim=keepdim)
         ret = x_sum / (mask_sum + EPS)
         if mask.size(dim) != x.size(dim):
             assert(mask.size(dim) == 1)
             ret = ret / x.size(dim)
-        return ret
+        return ret.to(x.dtype) if x.is_floating_point() else ret
 # endregion
 
 
 # region data-related utils
-def inf_batches(dataloader, with_info=True):
+def inf_batches(dataloader, with_info=True, prefetch=0, device=None):
     """
     iteration over this produces infinite batches from the dataloader
     returns <batch_data>, (<batch_number>, <epoch_number>) if with_info=True
         else just <batch_data>
+    if prefetch > 0, batches are prepared (and moved to device) in background by a BatchPrefetcher with that queue depth
     """
+    if prefetch > 0:
+        dataloader = BatchPrefetcher(dataloader, device=device, depth=prefetch)
     epoch = 0
     while True:
         for i, _batch in enumerate(dataloader):
@@ -183,6 +182,84 @@ def inf_batches(dataloader, with_info=True):
         epoch += 1
 
 
+class BatchPrefetcher(object):
+    """ Wraps a dataloader and iterates over it in a background thread, keeping up to depth batches ready.
+        Tensors in batches are moved to device in the background thread too
+        (from pinned memory with non_blocking copies when device is cuda).
+        Keeps track of how long and how often the consumer had to wait for a batch in the last iteration
+        (.stall_time, .stalls, .num_batches), to see whether training is input-bound. """
+    _end = object()
+
+    def __init__(self, dataloader, device=None, depth=2, pin_memory=True):
+        """
+        :param dataloader:  iterable over batches (e.g. torch DataLoader)
+        :param device:      device to move tensors in batches to (not moved if None)
+        :param depth:       maximum number of batches kept ready
+        :param pin_memory:  pin cpu tensors before copying to cuda device (ignored for non-cuda devices)
+        """
+        super(BatchPrefetcher, self).__init__()
+        self.dataloader = dataloader
+        self.device = torch.device(device) if isinstance(device, str) else device
+        self.depth = depth
+        self.pin_memory = pin_memory and self.device is not None and self.device.type == "cuda"
+        self.stall_time, self.stalls, self.num_batches = 0., 0, 0
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _transfer(self, x):
+        if isinstance(x, torch.Tensor) and self.device is not None:
+            if self.pin_memory and x.device.type == "cpu" and not x.is_pinned():
+                x = x.pin_memory()
+            x = x.to(self.device, non_blocking=self.pin_memory)
+        return x
+
+    def _produce(self, batchqueue, stop):
+        def _put(item):     # returns False if consumer stopped
+            while not stop.is_set():
+                try:
+                    batchqueue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        try:
+            for batch in self.dataloader:
+                if not _put((recmap(batch, self._transfer), None)):
+                    return
+            _put((self._end, None))
+        except Exception as e:
+            _put((None, e))
+
+    def __iter__(self):
+        self.stall_time, self.stalls, self.num_batches = 0., 0, 0
+        batchqueue = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(batchqueue, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                if batchqueue.empty():
+                    self.stalls += 1
+                    start = time.perf_counter()
+                    batch, exc = batchqueue.get()
+                    self.stall_time += time.perf_counter() - start
+                else:
+                    batch, exc = batchqueue.get()
+                if exc is not None:
+                    raise exc
+                if batch is self._end:
+                    break
+                self.num_batches += 1
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
+
+    def pp_stalls(self):
+        return "input wait {:.2f}s ({}/{} batches)".format(self.stall_time, self.stalls, self.num_batches)
+
+
 def tensor_dataset(*x):
     """ Creates a torch TensorDataset from list of tensors
         :param x: tensors as numpy arrays or torch tensors
@@ -221,9 +298,12 @@ class MultiDatasets(Dataset):
         self.datasets = datasets
 
     def __getitem__(self, item):
+        """ item can be a single index or a list (or 1D array/tensor) of indexes.
+            For a list of indexes, every sub-dataset is asked for the whole batch at once (see fetch_batch()) """
+        batched = not isinstance(item, (int, np.integer)) and not (isinstance(item, torch.Tensor) and item.dim() == 0)
         ret = tuple()
         for dataset in self.datasets:
-            ret_a = dataset[item]
+            ret_a = fetch_batch(dataset, item) if batched else dataset[item]
             if not isinstance(ret_a, tuple):
                 ret_a = (ret_a,)
             ret += ret_a
@@ -233,25 +313,175 @@ class MultiDatasets(Dataset):
         return len(self.datasets[0])
 
 
-def dataload(*tensors, batch_size=1, shuffle=False, **kw):
-    """ Loads provided tensors (numpy arrays, torch tensors, or torch datasets) into a torch dataloader.
+def fetch_batch(dataset, idxs):
+    """ Gets a batch of examples from dataset for given list of indexes.
+        Tensor datasets, MultiDatasets and IndexedDatasets are indexed once with all indexes (slicing the underlying tensors once),
+        other datasets are indexed per example and collated. """
+    if isinstance(dataset, (torch.utils.data.dataset.TensorDataset, MultiDatasets, IndexedDataset, torch.Tensor)):
+        return dataset[torch.as_tensor(idxs, dtype=torch.int64)]
+    else:
+        ret = torch.utils.data.dataloader.default_collate([dataset[i] for i in idxs])
+        return tuple(ret) if isinstance(ret, list) else ret
 
+
+def dataload(*tensors, batch_size=1, shuffle=False, bucket=None, max_tokens=None, batched=False, **kw):
+    """ Loads provided tensors (numpy arrays, torch tensors, or torch datasets) into a torch dataloader.
+    :param bucket:      (optional) enables length-bucketed batching (see BucketedBatchSampler). Can be:
+                            - int: position of the tensor among provided tensors to take lengths from
+                                   (non-zero entries in every row are counted, so a mask or a zero-padded id matrix)
+                            - lengths (1D) or mask (2D) as numpy array or torch tensor
+                            - a BucketedBatchSampler, used as is
+                        If shuffle is True, examples are shuffled among similar lengths and batch order is shuffled.
+    :param max_tokens:  (optional) with bucketing, maximum number of (padded) tokens per batch (replaces batch_size)
+    :param batched:     if True, a tensor dataset, MultiDatasets or IndexedDataset is indexed once per batch with the list of indexes
+                        of the batch (see fetch_batch()) instead of once per example followed by collation
     """
     if len(tensors) > 0 and isinstance(tensors[0], Dataset):
         if len(tensors) == 1:
             tensordataset = tensors[0]
         else:
-            tensordataset = q.datacat(*tensors, mode=1)
+            tensordataset = q.datacat(tensors, mode=1)
     else:
         tensordataset = tensor_dataset(*tensors)
-    dataloader = DataLoader(tensordataset, batch_size=batch_size, shuffle=shuffle, **kw)
+    batch_sampler = None
+    if bucket is not None:
+        drop_last = getkw(kw, "drop_last", False)   # DataLoader doesn't accept drop_last with a batch sampler
+        if not isinstance(bucket, BucketedBatchSampler):
+            if drop_last and max_tokens is not None:
+                raise q.SumTingWongException("drop_last is not supported with max_tokens")
+            lengths = tensors[bucket] if isinstance(bucket, int) else bucket
+            bucket = BucketedBatchSampler(lengths, batch_size=batch_size if max_tokens is None else None,
+                                          max_tokens=max_tokens,
+                                          shuffle=shuffle, shuffle_buckets=shuffle, drop_last=drop_last)
+        elif drop_last:
+            raise q.SumTingWongException("set drop_last on the given BucketedBatchSampler instead")
+        batch_sampler = bucket
+    elif batched:
+        sampler = torch.utils.data.RandomSampler(tensordataset) if shuffle \
+            else torch.utils.data.SequentialSampler(tensordataset)
+        batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=getkw(kw, "drop_last", False))
+    if batched and isinstance(tensordataset, (torch.utils.data.dataset.TensorDataset, MultiDatasets, IndexedDataset)):
+        # sampler yields whole batches, dataset is indexed with them (no per-example collation)
+        dataloader = DataLoader(tensordataset, sampler=batch_sampler, batch_size=None, **kw)
+    elif batch_sampler is not None:
+        dataloader = DataLoader(tensordataset, batch_sampler=batch_sampler, **kw)
+    else:
+        dataloader = DataLoader(tensordataset, batch_size=batch_size, shuffle=shuffle, **kw)
     return dataloader
 
 
-def datasplit(npmats, splits=(80, 20), random=True):
-    """ Splits given numpy arrays according to given split ratio's. Random split if random=True"""
+class BucketedBatchSampler(torch.utils.data.Sampler):
+    """ Batch sampler that groups examples of similar length to reduce padding.
+        Examples are sorted by length (ties in random order if shuffle), then split into consecutive batches
+        of batch_size examples and/or at most max_tokens padded tokens (batch size * longest length in batch). """
+    def __init__(self, lengths, batch_size=None, max_tokens=None, shuffle=False, shuffle_buckets=False,
+                 bucketsize=None, drop_last=False, seed=None):
+        """
+        :param lengths:         lengths of examples (1D) or mask (2D, non-zero entries in every row are counted),
+                                as numpy array or torch tensor
+        :param batch_size:      maximum number of examples per batch
+        :param max_tokens:      maximum number of padded tokens per batch (an example longer than this gets its own batch)
+        :param shuffle:         shuffle examples within buckets (of bucketsize similar-length examples) every epoch
+        :param shuffle_buckets: shuffle order of batches every epoch
+        :param bucketsize:      number of consecutive (length-sorted) examples in a bucket for shuffle.
+                                If None, shuffle only randomizes the order among examples of equal length.
+        :param drop_last:       drop last batch if it has less than batch_size examples (only if batch_size is given)
+        :param seed:            seed for the sampler's own random state
+        """
+        assert(batch_size is not None or max_tokens is not None)
+        if isinstance(lengths, torch.Tensor):
+            lengths = lengths.cpu().numpy()
+        lengths = np.asarray(lengths)
+        if lengths.ndim == 2:
+            lengths = (lengths != 0).sum(1)
+        self.lengths = lengths.astype("int64")
+        self.batch_size, self.max_tokens = batch_size, max_tokens
+        self.shuffle, self.shuffle_buckets = shuffle, shuffle_buckets
+        self.bucketsize = bucketsize
+        self.drop_last = drop_last
+        self.rng = np.random.RandomState(seed)
+        self._plan, self._plan_used = None, False     # batches of current/next epoch (so len() needn't rebuild them)
+        self._iterating = False
+
+    def _make_batches(self, shuffle=False, shuffle_buckets=False):
+        n = len(self.lengths)
+        order = self.rng.permutation(n) if shuffle else np.arange(n)
+        order = order[np.argsort(self.lengths[order], kind="stable")]
+        if shuffle and self.bucketsize is not None:
+            for i in range(0, n, self.bucketsize):
+                self.rng.shuffle(order[i:i + self.bucketsize])
+        batches = []
+        if self.max_tokens is None:
+            batches = [order[i:i + self.batch_size] for i in range(0, n, self.batch_size)]
+        else:
+            batch, batch_maxlen = [], 0
+            for i, l in zip(order.tolist(), self.lengths[order].tolist()):
+                newmaxlen = max(batch_maxlen, l)
+                if len(batch) > 0 and ((len(batch) + 1) * newmaxlen > self.max_tokens
+                                       or (self.batch_size is not None and len(batch) >= self.batch_size)):
+                    batches.append(batch)
+                    batch, newmaxlen = [], l
+                batch.append(i)
+                batch_maxlen = newmaxlen
+            if len(batch) > 0:
+                batches.append(batch)
+        if self.drop_last and self.batch_size is not None and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if shuffle_buckets:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        return [list(map(int, batch)) for batch in batches]
+
+    def __iter__(self):
+        if self._plan is None or self._plan_used:   # plan for new epoch (unless len() already made it)
+            self._plan = self._make_batches(shuffle=self.shuffle, shuffle_buckets=self.shuffle_buckets)
+        self._plan_used, self._iterating = True, True
+        try:
+            for batch in self._plan:
+                yield batch
+        finally:
+            self._iterating = False
+
+    def __len__(self):
+        """ number of batches in the current epoch (or the next one if not iterating).
+            With max_tokens and shuffle, the number of batches can differ slightly between epochs. """
+        if self.max_tokens is None:
+            n = len(self.lengths)
+            return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+        if self._plan is None or (self._plan_used and not self._iterating):     # next epoch's plan, used by __iter__
+            self._plan, self._plan_used = self._make_batches(shuffle=self.shuffle, shuffle_buckets=self.shuffle_buckets), False
+        return len(self._plan)
+
+
+def datasplit(npmats, splits=(80, 20), random=True, mode="copy"):
+    """ Splits given numpy arrays according to given split ratio's. Random split if random=True (or seed int).
+    :param mode:    "copy": returns for every split a list of copies of the selected rows of every array
+                            (seeds global np.random state if random is an int)
+                    "index": returns for every split the indexes of its rows (a slice if not random)
+                    "view": returns for every split an IndexedDataset over the arrays (usable in dataload())
+                    "index" and "view" don't copy the arrays (so memory-mapped arrays are not read)
+                    and use their own random state: random=True uses fresh entropy on every call,
+                    an int seed gives the same rows in every split as "copy" with that seed.
+    """
     splits = np.round(len(npmats[0]) * np.cumsum(splits) / sum(splits)).astype("int32")
 
+    if mode in ("index", "view"):
+        if random is not False and random is not None:
+            whatsplit = np.zeros((len(npmats[0]),), dtype="int64")
+            for i in range(1, len(splits)):
+                whatsplit[splits[i-1]:splits[i]] = i
+            seed = None if random is True else random     # (bool is an int too)
+            rng = np.random.RandomState(seed)
+            rng.shuffle(whatsplit)
+            idxs = [np.nonzero(whatsplit == i)[0] for i in range(0, len(splits))]
+        else:       # contiguous splits
+            idxs = [slice(a, b) for a, b in zip([0] + list(splits[:-1]), splits)]
+        if mode == "index":
+            return idxs
+        else:
+            return [IndexedDataset(npmats, idxs_i) for idxs_i in idxs]
+    elif mode != "copy":
+        raise q.SumTingWongException("mode {} not recognized".format(mode))
+
     whatsplit = np.zeros((len(npmats[0]),), dtype="int64")
     for i in range(1, len(splits)):
         a, b = splits[i-1], splits[i]
@@ -271,6 +501,35 @@ def datasplit(npmats, splits=(80, 20), random=True):
         ret.append(splitmats)
     return ret
 
+
+class IndexedDataset(Dataset):
+    """ Dataset of selected rows of given arrays (numpy arrays, memory-mapped arrays or tensors), without copying them.
+        Rows are only read when indexed. Can be indexed with a list of indexes to get a batch at once. """
+    def __init__(self, arrays, idxs=None):
+        """
+        :param arrays:  arrays to index together (same length)
+        :param idxs:    selected rows: index array or slice (all rows if None)
+        """
+        super(IndexedDataset, self).__init__()
+        for xe in arrays:
+            assert(len(xe) == len(arrays[0]))
+        if isinstance(idxs, slice):     # contiguous selection: use views
+            arrays, idxs = [xe[idxs] for xe in arrays], None
+        self.arrays, self.idxs = arrays, idxs
+
+    def __getitem__(self, item):
+        if isinstance(item, torch.Tensor):
+            item = item.cpu().numpy()
+        elif isinstance(item, list):
+            item = np.asarray(item, dtype="int64")
+        if self.idxs is not None:
+            item = self.idxs[item]
+        return tuple(xe[item] if isinstance(xe, torch.Tensor) else torch.from_numpy(np.array(xe[item]))
+                     for xe in self.arrays)
+
+    def __len__(self):
+        return len(self.arrays[0]) if self.idxs is None else len(self.idxs)
+
 # endregion
 
 
@@ -341,10 +600,16 @@ def isstring(x):
 
 
 class StringMatrix():
+    """ Tokenizes and maps strings to ids.
+        Token ids are stored ragged: a flat buffer of ids and an offsets array (string i is flat[offsets[i]:offsets[i+1]]).
+        After finalize(), the flat buffer uses the narrowest integer dtype that fits the vocabulary
+        and padded matrices are built on demand (pad() for a batch of strings, .matrix for all of them). """
     protectedwords = ["<MASK>", "<RARE>", "<START>", "<END>"]
 
     def __init__(self, maxlen=None, freqcutoff=0, topnwords=None, indicate_start_end=False, indicate_start=False, indicate_end=False):
-        self._strings = []
+        self._tokens = array.array("q")         # flat buffer of token ids of all strings
+        self._offsets = array.array("q", [0])   # start offset of every string in _tokens (+ end of last one)
+        self._finalized = False
         self._wordcounts_original = dict(zip(self.protectedwords, [0] * len(self.protectedwords)))
         self._dictionary = dict(zip(self.protectedwords, range(len(self.protectedwords))))
         self._dictionary_external = False
@@ -370,46 +635,83 @@ class StringMatrix():
     def clone(self):
         n = StringMatrix()
         n.tokenize = self.tokenize
-        if self._matrix is not None:
-            n._matrix = self._matrix.copy()
+        if self._finalized:
+            n._tokens = self._tokens.copy()
+            n._offsets = self._offsets.copy()
+            n._finalized = True
+            n._maxlen = self._maxlen
             n._dictionary = self._dictionary.copy()
             n._rd = self._rd.copy()
-
-        n._strings = self._strings
-        return n
-
-    def clone(self):
-        n = StringMatrix()
-        n.tokenize = self.tokenize
-        if self._matrix is not None:
-            n._matrix = self._matrix.copy()
-            n._dictionary = self._dictionary.copy()
-            n._rd = self._rd.copy()
-
-        n._strings = self._strings
+        else:
+            n._tokens = self._tokens
+            n._offsets = self._offsets
         return n
 
     def __len__(self):
-        if self._matrix is None:
-            return len(self._strings)
+        return len(self._offsets) - 1
+
+    def cached(self, p, xs, workers=1, chunksize=1000, tokenizer_id=None):
+        """ Fills and finalizes this StringMatrix with strings xs, using an on-disk cache in directory p.
+            The cache key is derived from xs, the settings of this StringMatrix and the tokenizer
+            (its code and settings, see _callable_key(), or the given tokenizer_id).
+            On a cache hit, the token ids are memory-mapped from disk instead of tokenizing xs again.
+        :param p:       cache directory
+        :param xs:      sequence of strings to add
+        :param workers, chunksize:  passed to add_many() on a cache miss
+        :param tokenizer_id:    (optional) string identifying self.tokenize (must change when the tokenizer changes).
+                                Required if no stable key can be derived from the tokenizer
+                                (e.g. for callable objects without a __repr__ of their settings).
+        :return:        self
+        """
+        assert(not self._finalized and len(self) == 0)
+        xs = xs if isinstance(xs, (list, tuple)) else list(xs)
+        self._cache_p = os.path.join(p, self._cache_key(xs, tokenizer_id=tokenizer_id))
+        if os.path.isfile(self._cache_p + ".meta.pkl"):
+            self._load(self._cache_p, mmap_mode="r")
         else:
-            return self.matrix.shape[0]
+            self.add_many(xs, workers=workers, chunksize=chunksize)
+            self.finalize()
+            os.makedirs(p, exist_ok=True)
+            self.save(self._cache_p)
+        return self
 
-    def cached(self, p):
-        self._cache_p = p
-        if os.path.isfile(p):
-            pickle.load()
+    def _cache_key(self, xs, tokenizer_id=None):
+        h = hashlib.sha1()
+        tokenizer = ("id", tokenizer_id) if tokenizer_id is not None else _callable_key(self.tokenize)
+        if tokenizer is None:
+            raise q.SumTingWongException("can't derive a cache key for tokenizer {}, provide tokenizer_id"
+                                         .format(self.tokenize))
+        settings = (self._max_allowable_length, self._rarefreq, self._topnwords, self._indic_s, self._indic_e,
+                    self.unseen_mode, tokenizer,
+                    sorted(self._dictionary.items()) if self._dictionary_external else None)
+        h.update(repr(settings).encode("utf-8"))
+        for x in xs:
+            x = x.encode("utf-8") if isinstance(x, str) else x
+            h.update(len(x).to_bytes(8, "little"))
+            h.update(x)
+        return h.hexdigest()
 
     def __getitem__(self, item, *args):
-        if self._matrix is None:
-            return self._strings[item]
+        if not self._finalized:
+            if isinstance(item, slice):
+                return [self._get_ids(i) for i in range(len(self))[item]]
+            return self._get_ids(item)
         else:
-            ret = self.matrix[item]
+            if isinstance(item, (int, np.integer)):
+                ret = self._get_ids(item)
+            else:
+                ret = self.pad(np.arange(len(self))[item])
             if len(args) == 1:
                 ret = ret[args[0]]
             ret = self.pp(ret)
             return ret
 
+    def _get_ids(self, i):
+        """ ids of i-th string (list before finalize, array after) """
+        i = range(len(self))[i]
+        ret = self._tokens[self._offsets[i]:self._offsets[i+1]]
+        return ret if self._finalized else list(ret)
+
     @property
     def numwords(self):
         return len(self._dictionary)
@@ -418,12 +720,39 @@ class StringMatrix():
     def numrare(self):
         return len(self._rarewords)
 
+    @property
+    def lengths(self):
+        """ number of tokens of every string """
+        return np.diff(np.asarray(self._offsets, dtype="int64"))
+
     @property
     def matrix(self):
-        if self._matrix is None:
+        """ (numstrings, maxlen) int64 matrix of all strings, padded with <MASK> (built on first access) """
+        if not self._finalized:
             raise Exception("finalize first")
+        if self._matrix is None:
+            self._matrix = self.pad(maxlen=self._maxlen)
         return self._matrix
 
+    def pad(self, idxs=None, maxlen=None):
+        """ Builds a padded int64 matrix for selected strings.
+        :param idxs:    indexes of strings to take (all if None)
+        :param maxlen:  length to pad to (length of longest selected string if None)
+        :return:        (len(idxs), maxlen) matrix padded with <MASK> id
+        """
+        if not self._finalized:
+            raise Exception("finalize first")
+        idxs = np.arange(len(self)) if idxs is None else np.asarray(idxs, dtype="int64")
+        starts = self._offsets[idxs]
+        lens = self._offsets[idxs + 1] - starts
+        if maxlen is None:
+            maxlen = int(lens.max()) if len(lens) > 0 else 0
+        positions = np.arange(maxlen)[None, :]
+        mask = positions < lens[:, None]
+        ret = np.full((len(idxs), maxlen), self._dictionary.get("<MASK>", 0), dtype="int64")
+        ret[mask] = self._tokens[(starts[:, None] + positions)[mask]]
+        return ret
+
     @property
     def D(self):
         return self._dictionary
@@ -462,16 +791,8 @@ class StringMatrix():
         return ret
 
     def add(self, x):
-        tokens = self.tokenize(x)
-        tokens = tokens[:self._max_allowable_length]
-        if self._indic_s is not False and self._indic_s is not None:
-            indic_s_sym = "<START>" if not isstring(self._indic_s) else self._indic_s
-            tokens = [indic_s_sym] + tokens
-        if self._indic_e is not False and self._indic_e is not None:
-            indic_e_sym = "<END>" if not isstring(self._indic_e) else self._indic_e
-            tokens = tokens + [indic_e_sym]
+        tokens = _stringmatrix_tokens(x, self.tokenize, self._max_allowable_length, self._indic_s, self._indic_e)
         self._maxlen = max(self._maxlen, len(tokens))
-        tokenidxs = []
         for token in tokens:
             if token not in self._dictionary:
                 if not self._dictionary_external and not self.unseen_mode:
@@ -482,75 +803,261 @@ class StringMatrix():
                     assert("<RARE>" in self._dictionary)
                     token = "<RARE>"    # replace tokens missing from external D with <RARE>
             self._wordcounts_original[token] += 1
-            tokenidxs.append(self._dictionary[token])
-        self._strings.append(tokenidxs)
-        return len(self._strings)-1
+            self._tokens.append(self._dictionary[token])
+        self._offsets.append(len(self._tokens))
+        return len(self)-1
+
+    def add_many(self, xs, workers=1, chunksize=1000):
+        """ Adds all strings from given iterable, tokenizing chunks of them in a process pool.
+            Resulting ids and counts are the same as when calling add() on every string in order.
+        :param xs:          iterable of strings
+        :param workers:     number of worker processes (if <= 1, tokenizes in this process).
+                            self.tokenize must be picklable when using more than one worker.
+        :param chunksize:   number of strings per chunk sent to a worker
+        :return:            range of indexes of the added strings
+        """
+        start = len(self)
+        xs = iter(xs)
+        chunks = iter(lambda: list(itertools.islice(xs, chunksize)), [])
+        tasks = ((chunk, self.tokenize, self._max_allowable_length, self._indic_s, self._indic_e) for chunk in chunks)
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                for result in pool.imap(_stringmatrix_tokenize_chunk, tasks):     # imap keeps chunk order
+                    self._merge_chunk(*result)
+        else:
+            for task in tasks:
+                self._merge_chunk(*_stringmatrix_tokenize_chunk(task))
+        return range(start, len(self))
+
+    def _merge_chunk(self, localwords, localcounts, localids, lens):
+        """ merges a chunk tokenized by _stringmatrix_tokenize_chunk into this StringMatrix.
+            localwords are in order of first occurrence, so new words get the same ids as with add() """
+        trans = np.zeros((len(localwords),), dtype="int64")
+        for i, (token, count) in enumerate(zip(localwords, localcounts.tolist())):
+            if token not in self._dictionary:
+                if not self._dictionary_external and not self.unseen_mode:
+                    self._dictionary[token] = self._next_available_id
+                    self._next_available_id += 1
+                    self._wordcounts_original[token] = 0
+                else:
+                    assert("<RARE>" in self._dictionary)
+                    token = "<RARE>"    # replace tokens missing from external D with <RARE>
+            self._wordcounts_original[token] += count
+            trans[i] = self._dictionary[token]
+        if len(lens) > 0:
+            self._maxlen = max(self._maxlen, int(lens.max()))
+        offsets = len(self._tokens) + np.cumsum(lens, dtype="int64")
+        self._tokens.frombytes(trans[localids].astype("int64").tobytes())
+        self._offsets.frombytes(offsets.tobytes())
 
     def finalize(self):
-        ret = np.zeros((len(self._strings), self._maxlen), dtype="int64")
-        for i, string in enumerate(self._strings):
-            ret[i, :len(string)] = string
-        self._matrix = ret
-        self._do_rare_sorted()
+        tokens = np.frombuffer(self._tokens, dtype="int64") if len(self._tokens) > 0 else np.zeros((0,), dtype="int64")
+        self._offsets = np.asarray(self._offsets, dtype="int64")
+        self._tokens = self._do_rare_sorted(tokens)
+        # store ids in narrowest integer type that fits the vocabulary
+        self._tokens = self._tokens.astype(np.min_scalar_type(max(self._dictionary.values())))
+        self._matrix = None
+        self._finalized = True
         self._rd = {v: k for k, v in self._dictionary.items()}
-        self._strings = None
 
-    def _do_rare_sorted(self):
-        """ if dictionary is not external, sorts dictionary by counts and applies rare frequency and dictionary is changed """
+    def _do_rare_sorted(self, tokens):
+        """ if dictionary is not external, sorts dictionary by counts and applies rare frequency and dictionary is changed.
+            Returns given flat array of token ids translated to the new ids. """
         if not self._dictionary_external:
-            sortedwordidxs = [self.d(x) for x in self.protectedwords] + \
-                             ([self.d(x) for x, y
-                              in sorted(list(self._wordcounts_original.items()), key=lambda x_y: x_y[1], reverse=True)
-                              if y >= self._rarefreq and x not in self.protectedwords][:self._topnwords])
-            transdic = zip(sortedwordidxs, range(len(sortedwordidxs)))
-            transdic = dict(transdic)
-            self._rarewords = {x for x in self._dictionary.keys() if self.d(x) not in transdic}
-            rarewords = {self.d(x) for x in self._rarewords}
-            self._numrare = len(rarewords)
-            transdic.update(dict(zip(rarewords, [self.d("<RARE>")]*len(rarewords))))
-            # translate matrix
-            self._matrix = np.vectorize(lambda x: transdic[x])(self._matrix)
+            words = np.array(list(self._wordcounts_original.keys()), dtype=object)
+            counts = np.fromiter(self._wordcounts_original.values(), dtype="int64", count=len(words))
+            oldids = np.fromiter(map(self._dictionary.__getitem__, words), dtype="int64", count=len(words))
+            protected = np.fromiter((x in self.protectedwords for x in words), dtype=bool, count=len(words))
+            # stable sort by descending count (same tie order as sorted(..., reverse=True))
+            order = np.argsort(-counts, kind="stable")
+            order = order[((counts >= self._rarefreq) & ~protected)[order]][:self._topnwords]
+            sortedwordidxs = np.concatenate([[self.d(x) for x in self.protectedwords], oldids[order]]).astype("int64")
+            # dense lookup table old id -> new id, unselected ids go to <RARE>
+            transarr = np.full(max(self._dictionary.values()) + 1, self.d("<RARE>"), dtype="int64")
+            transarr[sortedwordidxs] = np.arange(len(sortedwordidxs))
+            keep = np.zeros(len(transarr), dtype=bool)
+            keep[sortedwordidxs] = True
+            keep = keep[oldids]
+            self._rarewords = set(words[~keep].tolist())
+            self._numrare = len(self._rarewords)
+            # translate tokens
+            tokens = transarr[tokens]
             # change dictionary
-            self._dictionary = {k: transdic[v] for k, v in self._dictionary.items() if self.d(k) in sortedwordidxs}
+            self._dictionary = dict(zip(words[keep].tolist(), transarr[oldids[keep]].tolist()))
+        return tokens
 
     def save(self, p):
-        pickle.dump(self, open(p, "w"))
+        """ Saves finalized StringMatrix to files with prefix p:
+            token ids to p.tokens.npy and p.offsets.npy (memory-mappable), other data to p.meta.pkl """
+        if not self._finalized:
+            raise Exception("finalize first")
+        np.save(p + ".tokens.npy", self._tokens)
+        np.save(p + ".offsets.npy", self._offsets)
+        meta = {"dictionary": self._dictionary,
+                "dictionary_external": self._dictionary_external,
+                "wordcounts_original": self._wordcounts_original,
+                "rarewords": self._rarewords,
+                "maxlen": self._maxlen,
+                "settings": (self._max_allowable_length, self._rarefreq, self._topnwords, self._indic_s, self._indic_e)}
+        with open(p + ".meta.pkl", "wb") as f:     # written last: its presence marks a complete save
+            pickle.dump(meta, f)
 
     @staticmethod
-    def load(p):
-        if os.path.isfile(p):
-            return pickle.load(open(p))
+    def load(p, mmap_mode="r"):
+        """ Loads StringMatrix saved with save() at prefix p (None if not found).
+            Token ids are memory-mapped if mmap_mode is not None. """
+        if os.path.isfile(p + ".meta.pkl"):
+            return StringMatrix()._load(p, mmap_mode=mmap_mode)
         else:
             return None
 
+    def _load(self, p, mmap_mode="r"):
+        with open(p + ".meta.pkl", "rb") as f:
+            meta = pickle.load(f)
+        self._max_allowable_length, self._rarefreq, self._topnwords, self._indic_s, self._indic_e = meta["settings"]
+        self._dictionary = meta["dictionary"]
+        self._dictionary_external = meta["dictionary_external"]
+        self._wordcounts_original = meta["wordcounts_original"]
+        self._rarewords = meta["rarewords"]
+        self._maxlen = meta["maxlen"]
+        self._tokens = np.load(p + ".tokens.npy", mmap_mode=mmap_mode)
+        self._offsets = np.load(p + ".offsets.npy", mmap_mode=mmap_mode)
+        self._rd = {v: k for k, v in self._dictionary.items()}
+        self._matrix = None
+        self._finalized = True
+        return self
 
-def tokenize(s, preserve_patterns=None, extrasubs=True):
-    if not isinstance(s, str):
-        s = s.decode("utf-8")
-    s = unidecode.unidecode(s)
-    repldic = None
-    if preserve_patterns is not None:
-        repldic = {}
-        def _tokenize_preserve_repl(x):
-            id = max(list(repldic.keys()) + [-1]) + 1
-            repl = "replreplrepl{}".format(id)
-            assert(repl not in s)
-            assert(id not in repldic)
-            repldic[id] = x.group(0)
-            return repl
-        for preserve_pattern in preserve_patterns:
-            s = re.sub(preserve_pattern, _tokenize_preserve_repl, s)
-    if extrasubs:
-        s = re.sub("[-_\{\}/]", " ", s)
-    s = s.lower()
-    tokens = nltk.word_tokenize(s)
-    if repldic is not None:
-        repldic = {"replreplrepl{}".format(k): v for k, v in repldic.items()}
-        tokens = [repldic[token] if token in repldic else token for token in tokens]
-    s = re.sub("`", "'", s)
+def _code_key(code):
+    """ compiled code of a code object (also of nested functions), without file names and line numbers """
+    consts = tuple(_code_key(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts)
+    return code.co_code, consts, code.co_names, code.co_varnames
+
+
+def _callable_key(f):
+    """ Key of callable f from its code and settings (the same across processes), None if there isn't a stable one.
+        Functions (also lambdas and closures) are identified by their compiled code, defaults and closure values,
+        partials and bound methods by their function and arguments/object, other callables by their repr. """
+    if isinstance(f, (functools.partial, types.MethodType)):
+        func = f.func if isinstance(f, functools.partial) else f.__func__
+        funckey = _callable_key(func)
+        if funckey is None:
+            return None
+        key = ("partial", funckey, repr(f.args), repr(sorted(f.keywords.items()))) if isinstance(f, functools.partial) \
+            else ("method", funckey, repr(f.__self__))
+    elif isinstance(f, types.FunctionType):
+        closure = [cell.cell_contents for cell in f.__closure__] if f.__closure__ is not None else None
+        key = ("function", f.__module__, f.__qualname__, hashlib.sha1(repr(_code_key(f.__code__)).encode()).hexdigest(),
+               repr(f.__defaults__), repr(f.__kwdefaults__), repr(closure))
+    else:       # builtins, callable objects
+        key = ("callable", type(f).__module__, type(f).__qualname__, getattr(f, "__qualname__", None), repr(f))
+    if re.search(r" at 0x[0-9a-fA-F]+", repr(key)):
+        return None     # some part is identified by memory address
+    return key
+
+
+def _stringmatrix_tokens(x, tokenizer, maxlen, indic_s, indic_e):
+    """ tokenizes string x for StringMatrix: truncates to maxlen and adds start/end symbols """
+    tokens = tokenizer(x)
+    tokens = tokens[:maxlen]
+    if indic_s is not False and indic_s is not None:
+        indic_s_sym = "<START>" if not isstring(indic_s) else indic_s
+        tokens = [indic_s_sym] + tokens
+    if indic_e is not False and indic_e is not None:
+        indic_e_sym = "<END>" if not isstring(indic_e) else indic_e
+        tokens = tokens + [indic_e_sym]
     return tokens
 
 
+def _stringmatrix_tokenize_chunk(task):
+    """ worker for StringMatrix.add_many: tokenizes a chunk of strings and builds a local vocabulary.
+        Returns words in order of first occurrence, their counts, flat local ids and lengths of the strings. """
+    strings, tokenizer, maxlen, indic_s, indic_e = task
+    localdic = {}
+    ids = array.array("q")
+    lens = array.array("q")
+    for x in strings:
+        tokens = _stringmatrix_tokens(x, tokenizer, maxlen, indic_s, indic_e)
+        for token in tokens:
+            ids.append(localdic.setdefault(token, len(localdic)))
+        lens.append(len(tokens))
+    ids = np.asarray(ids, dtype="int64")
+    counts = np.bincount(ids, minlength=len(localdic))
+    return list(localdic.keys()), counts, ids, np.asarray(lens, dtype="int64")
+
+def tokenize(s, preserve_patterns=None, extrasubs=True):
+    return Tokenizer(preserve_patterns=preserve_patterns, extrasubs=extrasubs, cachesize=0)(s)
+
+
+class Tokenizer(object):
+    """ Callable tokenizer with precompiled patterns and an LRU cache of recently tokenized strings.
+        In default mode, produces the same tokens as tokenize().
+        In fast mode, nltk.word_tokenize is replaced by a single regex that approximates it
+        (splits off punctuation and clitics like "n't" and "'s", but does not do nltk's quote conversion). """
+    _extrasubs_re = re.compile(r"[-_{}/]")
+    _fast_re = re.compile(r"\d+(?:[.,]\d+)+|\w+(?=n't\b)|n't\b|'(?:s|m|d|ll|re|ve)\b|\w+|\.\.\.|[^\w\s]")
+
+    def __init__(self, preserve_patterns=None, extrasubs=True, fast=False, cachesize=100000):
+        """
+        :param preserve_patterns:   regexes whose matches are kept as single tokens
+        :param extrasubs:           replace "-", "_", "{", "}" and "/" with spaces before tokenizing
+        :param fast:                use pure regex tokenization instead of nltk.word_tokenize
+        :param cachesize:           maximum number of strings to keep in LRU cache (0 disables cache)
+        """
+        super(Tokenizer, self).__init__()
+        self.preserve_patterns = [re.compile(p) for p in preserve_patterns] if preserve_patterns is not None else None
+        self.extrasubs = extrasubs
+        self.fast = fast
+        self.cachesize = cachesize
+        self._cache = collections.OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __repr__(self):     # depends only on settings (used in StringMatrix cache key)
+        patterns = [p.pattern for p in self.preserve_patterns] if self.preserve_patterns is not None else None
+        return "Tokenizer(preserve_patterns={}, extrasubs={}, fast={})".format(patterns, self.extrasubs, self.fast)
+
+    def __getstate__(self):     # don't ship cache to other processes (e.g. in StringMatrix.add_many)
+        state = self.__dict__.copy()
+        state["_cache"] = collections.OrderedDict()
+        return state
+
+    def __call__(self, s):
+        if self.cachesize <= 0:
+            return self._tokenize(s)
+        if s in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(s)
+            return list(self._cache[s])
+        self.misses += 1
+        tokens = self._tokenize(s)
+        self._cache[s] = tuple(tokens)
+        if len(self._cache) > self.cachesize:
+            self._cache.popitem(last=False)
+        return tokens
+
+    def _tokenize(self, s):
+        if not isinstance(s, str):
+            s = s.decode("utf-8")
+        s = unidecode.unidecode(s)
+        repls = None
+        if self.preserve_patterns is not None:
+            repls = []
+            def _tokenize_preserve_repl(x):
+                repl = "replreplrepl{}".format(len(repls))
+                assert(repl not in s)
+                repls.append(x.group(0))
+                return repl
+            for preserve_pattern in self.preserve_patterns:
+                s = preserve_pattern.sub(_tokenize_preserve_repl, s)
+        if self.extrasubs:
+            s = self._extrasubs_re.sub(" ", s)
+        s = s.lower()
+        tokens = self._fast_re.findall(s) if self.fast else nltk.word_tokenize(s)
+        if repls is not None:
+            repldic = {"replreplrepl{}".format(i): v for i, v in enumerate(repls)}
+            tokens = [repldic[token] if token in repldic else token for token in tokens]
+        return tokens
+
+
 class ticktock(object):
     """ timer-printer thingy """
     def __init__(self, prefix="-", verbose=True):
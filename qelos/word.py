@@ -2,53 +2,196 @@ import torch
 import qelos as q
 from collections import OrderedDict
 import os
+import gzip
+import hashlib
+import itertools
 import numpy as np
 import json
 from copy import deepcopy
+from contextlib import contextmanager
 
 
-__all__ = ["WordEmb", "SwitchedWordEmb", "WordLinout"]
+__all__ = ["WordEmb", "SwitchedWordEmb", "WordEmbIndex", "WordLinout", "AdaptiveWordLinout"]
+
+
+def _select_ids(D, selectD):
+    """ Resolves words of selectD that are in D to index arrays.
+        Returns ids in D (source rows), ids in selectD (target rows) and new dictionary (words from selectD found in D) """
+    new_dic = {k: v for k, v in selectD.items() if k in D}
+    src = np.fromiter((D[k] for k in new_dic), dtype="int64", count=len(new_dic))
+    tgt = np.fromiter(new_dic.values(), dtype="int64", count=len(new_dic))
+    return src, tgt, new_dic
+
+
+def _counts_array(counts, D):
+    """ Converts word counts (dictionary mapping words to counts or sequence of counts per id)
+        to a float64 array of counts per id in D """
+    ret = np.zeros((max(D.values()) + 1,), dtype="float64")
+    if isinstance(counts, dict):
+        for k, v in counts.items():
+            if k in D:
+                ret[D[k]] = v
+    else:
+        counts = np.asarray(counts)[:len(ret)]
+        ret[:len(counts)] = counts
+    return ret
+
+
+def _gather_rows(W, src, tgt, vocsize):
+    """ Creates (vocsize, ...) array with rows src of W placed at rows tgt (other rows zero).
+        Rows of W are read in sorted order (sequential reads if W is memory-mapped). """
+    order = np.argsort(src, kind="stable")
+    ret = np.zeros((vocsize,) + W.shape[1:], dtype=W.dtype)
+    ret[tgt[order]] = W[src[order]]
+    return ret
 
 
 class VectorLoader(object):
     @classmethod
-    def load_pretrained_path(cls, path, selectD=None, **kw):
-        W, D = WordEmb._load_path(path)
+    def load_pretrained_path(cls, path, selectD=None, mmap_mode="r", cachedir=None, **kw):
+        """ Loads pretrained vectors from path (see _load_path).
+            The vectors are memory-mapped (if mmap_mode is not None), so with selectD, only selected rows are read.
+            If cachedir is given (and selectD), the selected vectors are cached in cachedir
+            and loaded from there next time (see _load_cached_selection).
+        """
+        if selectD is not None and cachedir is not None:
+            W, D = cls._load_cached_selection(path, selectD, cachedir, mmap_mode=mmap_mode)
+            selectD = None
+        else:
+            W, D = WordEmb._load_path(path, mmap_mode=mmap_mode)
         ret = cls.load_pretrained(W, D, selectD=selectD, **kw)
         return ret
 
+    @staticmethod
+    def _load_cached_selection(path, selectD, cachedir, mmap_mode="r"):
+        """ Returns vectors from path selected by selectD and the dictionary of the selected words (see load_pretrained).
+            Cache entries in cachedir are keyed by a hash of selectD and the size and modification time of the files
+            at path, so a changed selectD or changed vectors give a new entry.
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps(sorted(selectD.items())).encode("utf-8"))
+        for ext in (".npy", ".vocab", ".words"):
+            if os.path.isfile(path + ext):
+                stat = os.stat(path + ext)
+                h.update("{}:{}:{}".format(os.path.abspath(path + ext), stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+        cachepath = os.path.join(cachedir, h.hexdigest())
+
+        if os.path.isfile(cachepath + ".json"):
+            W = np.load(cachepath + ".npy")
+            with open(cachepath + ".json", encoding="utf8") as f:
+                D = json.load(f)
+            return W, D
+
+        W, D = WordEmb._load_path(path, mmap_mode=mmap_mode)
+        src, tgt, new_dic = _select_ids(D, selectD)
+        W = _gather_rows(W, src, tgt, max(selectD.values()) + 1)
+        os.makedirs(cachedir, exist_ok=True)
+        np.save(cachepath + ".npy", W)
+        with open(cachepath + ".json", "w", encoding="utf8") as f:
+            json.dump(new_dic, f)
+        return W, new_dic
+
     @classmethod
-    def transform_to_format(cls, path, outpath):
-        pass    # TODO: implement transformation from normal format to numpy + worddic format
+    def transform_to_format(cls, path, outpath, dtype="float32", chunksize=10000):
+        """ Converts embeddings in text format (GloVe, or word2vec with "<numwords> <dim>" header line, optionally .gz)
+            to the format loaded by load_pretrained_path(): outpath.npy (vectors), outpath.words (json list of words)
+            and outpath.vocab (words separated by newlines, loaded instead of .words when present).
+            Streams over the file: lines are parsed in chunks and written into a preallocated memory-mapped .npy,
+            so memory use does not depend on the number of vectors (except for the words).
+        :param path:        path of text file, every line: word followed by its vector values, separated by spaces
+        :param outpath:     path prefix to write to
+        :param dtype:       dtype to store vectors in (e.g. "float16" to halve file size)
+        :param chunksize:   number of lines parsed at once
+        :return:            number of words, dimension
+        """
+        def _open():
+            return gzip.open(path, "rt", encoding="utf8") if path.endswith(".gz") else open(path, encoding="utf8")
+
+        tt = q.ticktock("wordvec converter")
+        tt.tick("counting")
+        with _open() as f:
+            firstline = f.readline().rstrip("\n").split(" ")
+            header = len(firstline) == 2 and all(x.isdigit() for x in firstline)
+            if header:
+                numwords, dim = int(firstline[0]), int(firstline[1])
+            else:
+                dim = len(firstline) - 1
+                numwords = 1 + sum(1 for line in f if line.strip() != "")
+        tt.tock("{} words of dim {}".format(numwords, dim))
+
+        tt.tick("converting")
+        W = np.lib.format.open_memmap(outpath + ".npy", mode="w+", dtype=dtype, shape=(numwords, dim))
+        words = []
+        with _open() as f:
+            if header:
+                f.readline()
+            lines = (line for line in f if line.strip() != "")
+            i = 0
+            for chunk in iter(lambda: list(itertools.islice(lines, chunksize)), []):
+                splits = [line.rstrip().rsplit(" ", dim) for line in chunk]     # words can contain spaces
+                for j, split in enumerate(splits):
+                    if len(split) != dim + 1:
+                        raise q.SumTingWongException("line {} has {} values instead of {}"
+                                                     .format(i + j + 1 + header, len(split) - 1, dim))
+                vecs = np.fromstring(" ".join(" ".join(split[1:]) for split in splits), dtype="float32", sep=" ")
+                W[i:i + len(splits)] = vecs.reshape(len(splits), dim)
+                words.extend(split[0] for split in splits)
+                i += len(splits)
+                tt.live("{}/{}".format(i, numwords))
+        tt.stoplive()
+        if i != numwords:
+            raise q.SumTingWongException("expected {} words but found {}".format(numwords, i))
+        W.flush()
+        del W
+        with open(outpath + ".words", "w", encoding="utf8") as f:
+            json.dump(words, f)
+        with open(outpath + ".vocab", "w", encoding="utf8") as f:
+            f.write("\n".join(words))
+        tt.tock("converted")
+        return numwords, dim
 
     @staticmethod
-    def _load_path(path):
+    def _load_path(path, mmap_mode=None):
         """ Loads a path. Returns a numpy array (vocsize, dim) and dictionary from words to ids
-            :param path:    path where to load embeddings from. Must contain .npy and .words files.
+            :param path:    path where to load embeddings from. Must contain .npy and .words (or .vocab) files.
+                            A .vocab file is used instead of .words unless it is older than .words or .npy.
+            :param mmap_mode:   mmap_mode for np.load (None loads whole array in memory)
         """
         tt = q.ticktock("wordvec loader")
 
         # load weights
         tt.tick()
-        W = np.load(path+".npy")
+        W = np.load(path+".npy", mmap_mode=mmap_mode)
         tt.tock("vectors loaded")
 
         # load words
         tt.tick()
-        with open(path+".words") as f:
-            words = json.load(f)
-            D = dict(zip(words, range(len(words))))
+        # .vocab is only used if it isn't older than the vectors and .words (otherwise it could be stale)
+        mtime = lambda ext: os.path.getmtime(path + ext) if os.path.isfile(path + ext) else -np.inf
+        if os.path.isfile(path+".vocab") and mtime(".vocab") >= max(mtime(".npy"), mtime(".words")):
+            with open(path+".vocab", encoding="utf8") as f:
+                words = f.read().split("\n")
+        elif os.path.isfile(path+".words"):
+            with open(path+".words") as f:
+                words = json.load(f)
+        else:
+            with open(path+".vocab", encoding="utf8") as f:
+                words = f.read().split("\n")
+        if len(words) != W.shape[0]:
+            raise q.SumTingWongException("{} words for {} vectors at {}".format(len(words), W.shape[0], path))
+        D = dict(zip(words, range(len(words))))
         tt.tock("words loaded")
         return W, D
 
 
 class WordEmb(torch.nn.Embedding, VectorLoader):
     masktoken = "<MASK>"
+    _storage_dtypes = {"float16": torch.float16, "bfloat16": torch.bfloat16, "int8": torch.int8}
     """ is a VectorEmbed with a dictionary to map words to ids """
     def __init__(self, dim=None, worddic=None,
                  max_norm=None, norm_type=2, scale_grad_by_freq=False,
                  sparse=False, no_masking=False, word_dropout=0.,
-                 _weight=None,
+                 storage=None, _weight=None,
                  **kw):
         """
         Normal word embedder. Subclasses nn.Embedding.
@@ -66,6 +209,7 @@ class WordEmb(torch.nn.Embedding, VectorLoader):
         :param word_dropout: if >0, applies word-level embeddings (zeros complete word vectors).
                              The word dropout mask is shared across timesteps and examples in a batch.
                              Must call rec_reset() to sample new dropout mask for a new batch.
+        :param storage: (optional) dtype to store the table in, see .set_storage()
         :param kw:
         """
         assert(worddic is not None)     # always needs a dictionary
@@ -90,6 +234,10 @@ class WordEmb(torch.nn.Embedding, VectorLoader):
         self.word_dropout = torch.nn.Dropout(p=word_dropout) if word_dropout > 0 else None
         self._word_dropout_mask = None
 
+        self.register_buffer("weight_scale", None)      # (vocsize, 1) per-row scales if stored as int8
+        if storage is not None:
+            self.set_storage(storage)
+
     def batch_reset(self):
         self._word_dropout_mask = None
 
@@ -99,27 +247,98 @@ class WordEmb(torch.nn.Embedding, VectorLoader):
         if self.padding_idx is not None:
             self.weight.data[self.padding_idx].fill_(0)
 
-    def do_word_dropout(self, x):   # (batsize, ..., dim)
+    def _sample_word_dropout_mask(self, n):
+        word_dropout_mask = torch.ones(n, 1, device=self.weight.device)
+        return self.word_dropout(word_dropout_mask).clamp(0, 1)
+
+    def do_word_dropout(self, x, ids):   # (batsize, ..., dim), (batsize, ...)
+        """ Zeros vectors in x of dropped words (given by ids).
+            Masks are only sampled for the ids occurring in the batch. They are cached (as sorted ids + mask values)
+            and extended with new ids on later calls, so the same words are dropped until batch_reset(). """
         if self.training and self.word_dropout is not None:
-            if self._word_dropout_mask is None:
+            uniq, inverse = torch.unique(ids, return_inverse=True)      # uniq is sorted
+            if uniq.numel() == 0:
+                return x
+            if self._word_dropout_mask is None or self._word_dropout_mask[0].numel() == 0:
                 # sample new mask
-                word_dropout_mask = torch.ones(self.weight.size(0), 1, device=self.weight.device)
-                word_dropout_mask = self.word_dropout(word_dropout_mask).clamp(0, 1)
-                self._word_dropout_mask = word_dropout_mask     # cache mask for this batch
-            x_drop = self._word_dropout_mask[x]
+                mask = self._sample_word_dropout_mask(len(uniq))
+                self._word_dropout_mask = (uniq, mask)     # cache mask for this batch
+            else:
+                known_ids, known_mask = self._word_dropout_mask
+                pos = torch.searchsorted(known_ids, uniq).clamp(max=len(known_ids) - 1)
+                found = known_ids[pos] == uniq
+                if not bool(found.all()):   # extend cached mask with ids not seen before in this batch
+                    new_ids = uniq[~found]
+                    known_ids, order = torch.sort(torch.cat([known_ids, new_ids]))
+                    known_mask = torch.cat([known_mask, self._sample_word_dropout_mask(len(new_ids))])[order]
+                    self._word_dropout_mask = (known_ids, known_mask)
+                    pos = torch.searchsorted(known_ids, uniq)
+                mask = known_mask[pos]
+            x_drop = mask[inverse]
             x = x * x_drop
         return x
 
     def forward(self, x):
         ret = super(WordEmb, self).forward(x)
-        ret = self.do_word_dropout(ret)
+        if ret.dtype in self._storage_dtypes.values():     # dequantize gathered rows
+            ret = ret.float()
+            if self.weight_scale is not None:
+                ret = ret * self.weight_scale[x]
+        ret = self.do_word_dropout(ret, x)
         mask = None
         if self.padding_idx is not None:
             mask = (x != self.padding_idx).int()
         return ret, mask
 
-    def freeze(self, val:bool=True):
+    def freeze(self, val:bool=True, storage=None):
+        """
+        :param val:     freeze (True) or unfreeze (False)
+        :param storage: (optional) dtype to store the frozen table in, e.g. "int8", see .set_storage()
+        """
+        if not val and self.weight_scale is not None:
+            raise q.SumTingWongException("can't unfreeze int8 table, call .set_storage() first")
         self.weight.requires_grad = not val
+        if storage is not None:
+            self.set_storage(storage)
+        return self
+
+    def set_storage(self, storage=None):
+        """
+        Changes the dtype the table is stored in. Only the rows gathered in forward are converted back to float32.
+        :param storage: "float16" or "bfloat16": table stays trainable (the optimizer updates the reduced precision copy)
+                        "int8": rows are quantized with a per-row scale, table is frozen
+                        "float32" or None: back to full precision
+        :return:        self
+        """
+        storage = "float32" if storage is None else storage
+        if storage not in self._storage_dtypes and storage != "float32":
+            raise q.SumTingWongException("unknown storage '{}'".format(storage))
+        requires_grad = self.weight.requires_grad
+        W = self.weight.detach()
+        if self.weight_scale is not None:
+            W = W.float() * self.weight_scale
+        del self.weight     # parameter or int8 buffer
+        self.weight_scale = None
+        if storage == "int8":
+            scale = W.float().abs().max(1, keepdim=True)[0] / 127.
+            scale[scale == 0] = 1.
+            self.register_buffer("weight", torch.round(W.float() / scale).clamp(-127, 127).to(torch.int8))
+            self.weight_scale = scale
+        else:
+            dtype = self._storage_dtypes.get(storage, torch.float32)
+            self.weight = torch.nn.Parameter(W.to(dtype), requires_grad=requires_grad)
+        return self
+
+    def nn_index(self, **kw):
+        """ Nearest neighbour index over the current vectors of this table, see WordEmbIndex """
+        return WordEmbIndex(self, **kw)
+
+    @property
+    def storage(self):
+        for k, v in self._storage_dtypes.items():
+            if self.weight.dtype == v:
+                return k
+        return "float32"
 
     @classmethod
     def load_pretrained(cls, W, D, selectD=None, **kw): #weights, worddic=None):
@@ -139,15 +358,13 @@ class WordEmb(torch.nn.Embedding, VectorLoader):
         # rearrange according to newD
         if selectD is not None:
             vocsize = max(selectD.values()) + 1
-            new_weight = np.zeros((vocsize, W.shape[1]), dtype=W.dtype)
-            new_dic = {}
-            for k, v in selectD.items():
-                if k in D:
-                    new_weight[v, :] = W[D[k], :]
-                    new_dic[k] = v
-            W, D = new_weight, new_dic
+            src, tgt, new_dic = _select_ids(D, selectD)
+            W, D = _gather_rows(W, src, tgt, vocsize), new_dic
 
         # create
+        W = np.asarray(W)
+        if W.dtype == np.float16 and kw.get("storage", None) != "float16":
+            W = W.astype("float32")     # vectors can be stored as float16
         W = torch.tensor(W)
         ret = cls(dim=dim, worddic=D, _weight=W, **kw)
         return ret
@@ -194,17 +411,146 @@ class SwitchedWordEmb(torch.nn.Module):
         return self
 
     def forward(self, x):   # (batsize, ...,) int ids
-        baseemb, basemask = self.base(x)
-        otherembs = [other(x)[0] for other in self.other_embs]
-        catemb = torch.stack([baseemb]+otherembs, -1)   # (batsize, ..., dim, numembs)
-        selmask = self.select_mask[x]   # (batsize, ..., 1) int ids of which embedder to use
-        selmaskrep = [1] * (selmask.dim() - 1) + [catemb.size(-2)]
-        selmask = selmask.repeat(*selmaskrep).unsqueeze(-1)
-        ret = torch.gather(catemb, -1, selmask).squeeze(-1) # (batsize, ..., dim)
-        ret = self.base.do_word_dropout(ret)
+        # every id is only looked up in the embedder selected for it --> one lookup per id regardless of #overrides
+        flat_x = x.reshape(-1)
+        selmask = self.select_mask[flat_x].squeeze(-1)     # (numids,) int ids of which embedder to use
+        ret = None
+        for i, emb in enumerate([self.base] + list(self.other_embs)):
+            pos = (selmask == i).nonzero().squeeze(-1)     # positions routed to this embedder
+            if len(pos) == 0:
+                continue
+            emb_i, _ = emb(flat_x[pos])     # (len(pos), dim)
+            if ret is None:
+                ret = emb_i.new_zeros(flat_x.size(0), emb_i.size(-1))
+            ret.index_copy_(0, pos, emb_i)
+        if ret is None:     # no ids at all
+            ret, _ = self.base(flat_x)
+        ret = ret.view(x.size() + (ret.size(-1),))     # (batsize, ..., dim)
+        ret = self.base.do_word_dropout(ret, x)
+        basemask = (x != self.base.padding_idx).int() if self.base.padding_idx is not None else None
         return ret, basemask
 
 
+class WordEmbIndex(object):
+    """
+    Cosine similarity nearest neighbour index over the vectors of a WordEmb (snapshot taken at creation).
+    Exact search compares queries with all vectors in chunks of chunksize words, so memory stays bounded.
+    If numclusters > 0, vectors are clustered with (spherical) k-means and queries are only compared
+    with the vectors in the nprobe clusters with closest centroids (approximate, IVF-style).
+    """
+    def __init__(self, emb, numclusters=0, nprobe=8, niter=10, chunksize=10000, seed=0):
+        """
+        :param emb:         WordEmb to index (all words in emb.D except the mask word)
+        :param numclusters: number of clusters for approximate search (e.g. ~sqrt(#words)), 0 for exact search
+        :param nprobe:      number of clusters to search per query
+        :param niter:       number of k-means iterations
+        :param chunksize:   number of vectors to compare with at once
+        :param seed:        seed for k-means initialization
+        """
+        super(WordEmbIndex, self).__init__()
+        self.D, self.chunksize, self.nprobe = emb.D, chunksize, nprobe
+        self.rD = {v: k for k, v in emb.D.items()}
+        with torch.no_grad():
+            self.ids = torch.tensor(sorted(v for v in set(emb.D.values()) if v != emb.padding_idx),
+                                    dtype=torch.int64, device=emb.weight.device)   # position in index -> word id
+            W = emb.weight[self.ids].float()
+            if emb.weight_scale is not None:
+                W = W * emb.weight_scale[self.ids]
+            self.W = self._normalize(W)     # (numwords, dim)
+
+        self.centroids, self.cluster_order, self.cluster_offsets = None, None, None
+        if numclusters > 0:
+            self._build_clusters(min(numclusters, len(self.ids)), niter, seed)
+
+    @staticmethod
+    def _normalize(x):
+        return x / x.norm(dim=-1, keepdim=True).clamp(min=1e-12)
+
+    def _assign(self, X, centroids):
+        """ closest centroid for every row of X, computed in chunks """
+        return torch.cat([torch.matmul(X[i:i + self.chunksize], centroids.t()).argmax(1)
+                          for i in range(0, len(X), self.chunksize)])
+
+    def _build_clusters(self, numclusters, niter, seed):
+        g = torch.Generator().manual_seed(seed)
+        centroids = self.W[torch.randperm(len(self.W), generator=g)[:numclusters].to(self.W.device)]
+        for i in range(niter):
+            assign = self._assign(self.W, centroids)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, self.W)
+            empty = (sums == 0).all(1, keepdim=True)    # empty clusters keep their centroid
+            centroids = torch.where(empty, centroids, self._normalize(sums))
+        assign = self._assign(self.W, centroids)
+        self.centroids = centroids      # (numclusters, dim)
+        # inverted lists: positions of cluster i are cluster_order[cluster_offsets[i]:cluster_offsets[i+1]]
+        self.cluster_order = torch.argsort(assign, stable=True)
+        counts = torch.bincount(assign, minlength=numclusters)
+        self.cluster_offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)]).tolist()
+
+    def search(self, x, k=10, exclude_self=True):
+        """
+        :param x:       (numqueries, dim) query vectors or (numqueries,) int word ids (must be in the index,
+                        so not the mask id)
+        :param k:       number of neighbours
+        :param exclude_self:    if x are word ids, don't return the query word as its own neighbour
+        :return:        (numqueries, k) cosine similarities and (numqueries, k) word ids, sorted by decreasing similarity
+        """
+        with torch.no_grad():
+            exclude = None
+            if not torch.is_floating_point(x):
+                x = x.to(self.ids.device)
+                exclude = x if exclude_self else None
+                pos = torch.searchsorted(self.ids, x).clamp(max=len(self.ids) - 1)
+                missing = self.ids[pos] != x
+                if bool(missing.any()):
+                    raise q.SumTingWongException("word ids {} are not in the index".format(x[missing].unique().tolist()))
+                x = self.W[pos]
+            x = self._normalize(x.float().to(self.W.device))
+            if self.centroids is None:
+                scores, pos = self._search_exact(x, k, exclude)
+            else:
+                scores, pos = self._search_clusters(x, k, exclude)
+            return scores, self.ids[pos]
+
+    def _search_exact(self, x, k, exclude):
+        best_scores = x.new_zeros(len(x), 0)
+        best_pos = torch.zeros(len(x), 0, dtype=torch.int64, device=x.device)
+        for i in range(0, len(self.W), self.chunksize):
+            scores = torch.matmul(x, self.W[i:i + self.chunksize].t())     # (numqueries, chunksize)
+            pos = torch.arange(i, i + scores.size(1), device=x.device).unsqueeze(0).expand_as(scores)
+            if exclude is not None:
+                scores = scores.masked_fill(self.ids[pos] == exclude.unsqueeze(1), -np.inf)
+            scores, pos = torch.cat([best_scores, scores], 1), torch.cat([best_pos, pos], 1)
+            best_scores, sel = scores.topk(min(k, scores.size(1)), 1)
+            best_pos = pos.gather(1, sel)
+        return best_scores, best_pos
+
+    def _search_clusters(self, x, k, exclude):
+        probes = torch.matmul(x, self.centroids.t()).topk(min(self.nprobe, len(self.centroids)), 1)[1].tolist()
+        ret_scores = x.new_full((len(x), k), -np.inf)
+        ret_pos = torch.zeros(len(x), k, dtype=torch.int64, device=x.device)
+        for i, probes_i in enumerate(probes):
+            cand = torch.cat([self.cluster_order[self.cluster_offsets[c]:self.cluster_offsets[c + 1]] for c in probes_i])
+            scores = torch.matmul(self.W[cand], x[i])
+            if exclude is not None:
+                scores = scores.masked_fill(self.ids[cand] == exclude[i], -np.inf)
+            scores, sel = scores.topk(min(k, len(cand)))
+            ret_scores[i, :len(sel)], ret_pos[i, :len(sel)] = scores, cand[sel]
+        return ret_scores, ret_pos
+
+    def nearest(self, words, k=10):
+        """
+        :param words:   word (string) or list of words in D
+        :param k:       number of neighbours
+        :return:        list of k (word, similarity) tuples (or list of such lists if a list of words was given)
+        """
+        single = isinstance(words, str)
+        words = [words] if single else words
+        scores, ids = self.search(torch.tensor([self.D[word] for word in words]), k=k)
+        ret = [[(self.rD[i], s) for i, s in zip(ids_i, scores_i) if s > -np.inf]
+               for ids_i, scores_i in zip(ids.tolist(), scores.tolist())]
+        return ret[0] if single else ret
+
+
 class WordLinout(torch.nn.Linear):
     def __init__(self, dim=None, worddic=None, bias=True, _weight=None, _bias=None, **kw):
         assert(worddic is not None)     # always needs a dictionary
@@ -214,6 +560,7 @@ class WordLinout(torch.nn.Linear):
         outdim = max(worddic.values())+1        # to init from worddic
 
         super(WordLinout, self).__init__(dim, outdim, bias=bias)
+        self.shortlist = None       # (numcandidates,) int ids, if set, scores are only computed for these ids
 
         if _weight is None:
             assert(_bias is None)
@@ -231,6 +578,9 @@ class WordLinout(torch.nn.Linear):
             self.bias.data.zero_()
 
     def forward(self, x):
+        if self.shortlist is not None:      # (batsize, ..., numcandidates) scores, use .to_global() to get ids
+            bias = self.bias[self.shortlist] if self.bias is not None else None
+            return torch.nn.functional.linear(x, self.weight[self.shortlist], bias)
         ret = super(WordLinout, self).forward(x)
         return ret
 
@@ -238,6 +588,53 @@ class WordLinout(torch.nn.Linear):
         self.weight.requires_grad = not val
         self.bias.requires_grad = not val
 
+    def set_shortlist(self, ids=None, words=None, topn=0, counts=None):
+        """
+        Restricts output to a set of candidate ids (intended for inference).
+        Scores are then only computed for the sorted unique candidate ids (see .shortlist)
+        and .to_global() maps positions in the output to ids in self.D.
+        Clears the shortlist if nothing is given.
+        :param ids:     int ids (tensor or sequence), e.g. from source sentences in the batch
+        :param words:   words (strings), mapped using self.D (unknown words are ignored)
+        :param topn:    number of most frequent words to add
+        :param counts:  word frequencies for topn: dictionary mapping words to counts or sequence of counts per id.
+                        If None, ids are assumed to be sorted by decreasing frequency.
+        :return:        self
+        """
+        parts = []
+        if ids is not None:
+            parts.append(torch.as_tensor(ids, dtype=torch.int64).reshape(-1).cpu())
+        if words is not None:
+            parts.append(torch.tensor([self.D[word] for word in words if word in self.D], dtype=torch.int64))
+        if topn > 0:
+            if counts is None:
+                parts.append(torch.arange(min(topn, self.weight.size(0))))
+            else:
+                parts.append(torch.tensor(np.argsort(-_counts_array(counts, self.D), kind="stable")[:topn]))
+        if len(parts) == 0:
+            self.shortlist = None
+        else:
+            self.shortlist = torch.unique(torch.cat(parts)).to(self.weight.device)
+        return self
+
+    def to_global(self, x):
+        """ Maps positions in shortlisted output (e.g. argmax) to ids in self.D """
+        if self.shortlist is None:
+            return x
+        return self.shortlist[x]
+
+    @contextmanager
+    def shortlisted(self, ids=None, words=None, topn=0, counts=None):
+        """ Temporary shortlist, see .set_shortlist(), previous shortlist is restored afterwards:
+                with linout.shortlisted(ids=src, topn=1000):
+                    ... """
+        prev = self.shortlist
+        self.set_shortlist(ids=ids, words=words, topn=topn, counts=counts)
+        try:
+            yield self
+        finally:
+            self.shortlist = prev
+
     @classmethod
     def load_pretrained(cls, W, b=None, D=None, selectD=None, **kw): #weights, worddic=None):
         """
@@ -256,19 +653,71 @@ class WordLinout(torch.nn.Linear):
         # rearrange according to newD
         if selectD is not None:
             vocsize = max(selectD.values()) + 1
-            new_weight = np.zeros((vocsize, W.shape[1]), dtype=W.dtype)
-            new_bias = np.zeros((vocsize,), dtype=b.dtype) if b is not None else None
-            new_dic = {}
-            for k, v in selectD.items():
-                if k in D:
-                    new_weight[v, :] = W[D[k], :]
-                    if new_bias is not None:
-                        new_bias[v] = b[D[k]]
-                    new_dic[k] = v
-            W, D, b = new_weight, new_dic, new_bias
+            src, tgt, new_dic = _select_ids(D, selectD)
+            new_bias = _gather_rows(b, src, tgt, vocsize) if b is not None else None
+            W, D, b = _gather_rows(W, src, tgt, vocsize), new_dic, new_bias
 
         # create
         W = torch.tensor(W)
         b = torch.tensor(b) if b is not None else None
         ret = cls(dim=dim, worddic=D, _weight=W, _bias=b, **kw)
-        return ret
\ No newline at end of file
+        return ret
+
+
+class AdaptiveWordLinout(torch.nn.Module):
+    """
+    Adaptive softmax output layer (Grave et al., 2017) over the words of a worddic.
+    Words are ranked by frequency and split into a head (most frequent words + one entry per tail cluster)
+    and tail clusters with smaller projections.
+    Calling it returns log-probabilities over all ids in worddic (like WordLinout returns logits),
+    use AdaptiveCELoss on the hidden states to train without computing the full output.
+    """
+    def __init__(self, dim=None, worddic=None, counts=None, cutoffs=None, div_value=4., head_bias=False, **kw):
+        """
+        :param dim:         input dimension
+        :param worddic:     dictionary mapping words to ids
+        :param counts:      word frequencies: dictionary mapping words to counts or sequence of counts per id.
+                            If None, ids are assumed to be sorted by decreasing frequency.
+        :param cutoffs:     frequency ranks at which to split the vocabulary in clusters.
+                            By default, the head contains the 5% most frequent words and the rest is split at 25%.
+        :param div_value:   factor by which projection dimension is reduced for every next cluster
+        :param head_bias:   use bias in the head
+        """
+        super(AdaptiveWordLinout, self).__init__(**kw)
+        assert(worddic is not None)     # always needs a dictionary
+        self.D = worddic
+        assert(min(worddic.values()) >= 0)
+        vocsize = max(worddic.values()) + 1
+
+        if counts is None:
+            freqs = -np.arange(vocsize, dtype="float64")      # lower id = more frequent
+        else:
+            freqs = _counts_array(counts, worddic)
+        rank2id = np.argsort(-freqs, kind="stable")
+        id2rank = np.empty_like(rank2id)
+        id2rank[rank2id] = np.arange(vocsize)
+        self.register_buffer("id2rank", torch.tensor(id2rank))
+        self.register_buffer("rank2id", torch.tensor(rank2id))
+
+        if cutoffs is None:
+            cutoffs = [vocsize // 20, vocsize // 4]
+        cutoffs = sorted(set([cutoff for cutoff in cutoffs if 0 < cutoff < vocsize]))
+        if len(cutoffs) == 0:
+            raise q.SumTingWongException("no valid cutoffs for vocabulary of size {}".format(vocsize))
+        self.asm = torch.nn.AdaptiveLogSoftmaxWithLoss(dim, vocsize, cutoffs, div_value=div_value, head_bias=head_bias)
+
+    @property
+    def cutoffs(self):
+        return self.asm.cutoffs[:-1]
+
+    def forward(self, x):   # (batsize, ..., dim)
+        """ Full log-probabilities over all ids in worddic: (batsize, ..., vocsize) """
+        logprobs = self.asm.log_prob(x.reshape(-1, x.size(-1)))      # (numel, vocsize) in frequency rank order
+        logprobs = logprobs.index_select(1, self.id2rank)            # back to worddic ids
+        return logprobs.view(x.size()[:-1] + (logprobs.size(-1),))
+
+    def gold_log_prob(self, x, gold):    # (batsize, ..., dim), (batsize, ...) int ids
+        """ Log-probabilities of gold ids only, only computes the clusters needed: (batsize, ...) """
+        ranks = self.id2rank[gold.reshape(-1)]
+        ret = self.asm(x.reshape(-1, x.size(-1)), ranks).output
+        return ret.view(gold.size())
@@ -98,6 +98,30 @@ class TestCELoss(TestCase):
         self.assertTrue((l - lref).norm(1).item() < 1e-6)
 
 
+class TestSampledCELoss(TestCase):
+    def test_it(self):
+        D = dict(zip(["<MASK>"] + ["w{}".format(i) for i in range(1, 50)], range(50)))
+        linout = q.WordLinout(8, worddic=D)
+        counts = np.random.randint(0, 100, (50,))
+        m = q.SampledCELoss(linout, counts, numsamples=10, ignore_index=0)
+        x = torch.randn(4, 3, 8)
+        g = torch.randint(1, 50, (4, 3))
+        g[:, -1] = 0
+        l = m(x, g)
+        print(l)
+        self.assertTrue(l.item() > 0 and l.item() < np.inf)
+        l.backward()
+        # only gold and sampled rows get gradient
+        gradrows = (linout.weight.grad.abs().sum(1) > 0).long().sum().item()
+        self.assertTrue(gradrows <= 8 + 10)
+
+        # exact cross entropy in eval mode
+        linout.eval()
+        l = m(x, g)
+        lref = q.CELoss(mode="logits", ignore_index=0)(linout(x), g)
+        self.assertTrue(abs(l.item() - lref.item()) < 1e-6)
+
+
 class TestSmoothedCELoss(TestCase):
     def test_it(self):
         m = q.SmoothedCELoss(smoothing=0.2, mode="logits")
@@ -313,6 +313,24 @@ class TestRNNEncoder(TestCase):
 
         print("done")
 
+    def test_packed_equals_unpacked(self):
+        lens = [2, 5, 3, 4]     # not sorted by length
+        x = torch.randn(len(lens), max(lens), 6)
+        mask = (torch.arange(max(lens))[None, :] < torch.tensor(lens)[:, None]).long()
+        numstates = 2 if self.encodertype == q.LSTMEncoder else 1
+        states_0 = tuple([torch.randn(len(lens), 1, 7), torch.randn(len(lens), 1, 8)] for _ in range(numstates))
+        # tiny dropout rates: (practically) nothing is dropped, but the training-time dropout paths are used
+        for kw in [dict(), dict(layer_norm=True), dict(dropout_in=1e-9), dict(dropout_in_shared=1e-9),
+                   dict(layer_norm=True, dropout_in=1e-9)]:
+            enc = self.encodertype(6, 7, 8, **kw)
+            y, y_T = enc._forward(x, mask=mask, states_0=states_0, ret_states=True)
+            for i, l in enumerate(lens):
+                states_0_i = tuple([state[i:i+1] for state in states] for states in states_0)
+                y_i, y_T_i = enc._forward(x[i:i+1, :l], states_0=states_0_i, ret_states=True)
+                self.assertTrue(torch.allclose(y[i, :l], y_i[0], atol=1e-6), kw)
+                self.assertTrue(torch.allclose(y_T[i], y_T_i[0], atol=1e-6), kw)
+                self.assertTrue(torch.all(y[i, l:] == 0))
+
     def test_init_states(self):
         batsize = 5
         seqlen = 4
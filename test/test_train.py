@@ -0,0 +1,290 @@
+from unittest import TestCase, mock
+import qelos as q
+import torch
+from functools import partial
+import json
+import os
+import tempfile
+
+
+class TestTrainEpoch(TestCase):
+    def test_prefetch(self):
+        torch.manual_seed(0)
+        x = torch.randn(64, 5)
+        y = (x.sum(1) > 0).long()
+        m = torch.nn.Linear(5, 2)
+        optim = torch.optim.SGD(m.parameters(), lr=0.5)
+        loss = q.LossWrapper(q.CELoss(mode="logits"))
+        dl = q.dataload(x, y, batch_size=16, shuffle=True)
+        for epoch in range(5):
+            msg = q.train_epoch(model=m, dataloader=dl, optim=optim, losses=[loss], prefetch=2,
+                                current_epoch=epoch, max_epochs=5)
+            print(msg)
+        self.assertTrue("input wait" in msg)
+        self.assertTrue(loss.get_epoch_error() < 0.5)
+        testloss = q.LossWrapper(q.CELoss(mode="logits"))
+        msg = q.test_epoch(model=m, dataloader=q.BatchPrefetcher(dl), losses=[testloss])
+        self.assertTrue("input wait" in msg)
+        self.assertTrue(abs(testloss.get_epoch_error() - loss.get_epoch_error()) < 0.2)
+
+
+class TestLossWrapper(TestCase):
+    def test_aggregation(self):
+        loss = q.LossWrapper(q.CELoss(mode="logits"))
+        values, sizes = [], []
+        for n in [5, 3, 7]:
+            x, g = torch.randn(n, 4), torch.randint(0, 4, (n,))
+            values.append(loss(x, g).item())
+            sizes.append(n)
+        self.assertTrue(isinstance(loss.epoch_agg_sum, torch.Tensor))     # not materialized yet
+        ref = sum(v * s for v, s in zip(values, sizes)) / sum(sizes)
+        self.assertTrue(abs(loss.get_epoch_error() - ref) < 1e-6)
+        loss.push_epoch_to_history()
+        loss.reset_agg()
+        self.assertEqual(loss.get_epoch_error(), 0.)
+        self.assertTrue(abs(loss.agg_history[0] - ref) < 1e-6)
+
+    def test_print_every(self):
+        x = torch.randn(100, 5)
+        y = (x.sum(1) > 0).long()
+        m = torch.nn.Linear(5, 2)
+        optim = torch.optim.SGD(m.parameters(), lr=0.5)
+        loss = q.LossWrapper(q.CELoss(mode="logits"))
+        dl = q.dataload(x, y, batch_size=10)
+        with mock.patch.object(q, "pp_epoch_losses", wraps=q.pp_epoch_losses) as pp:
+            q.train_epoch(model=m, dataloader=dl, optim=optim, losses=[loss], print_every=4)
+            self.assertEqual(pp.call_count, 3 + 1)      # batches 4, 8, 10 + epoch end
+            pp.reset_mock()
+            q.test_epoch(model=m, dataloader=dl, losses=[loss], print_every=5)
+            self.assertEqual(pp.call_count, 2 + 1)
+
+
+class WrongLenLoader(object):
+    def __init__(self, dl, n):
+        self.dl, self.n = dl, n
+
+    def __iter__(self):
+        return iter(self.dl)
+
+    def __len__(self):
+        return self.n
+
+
+class TestAccumulation(TestCase):
+    def run_epoch(self, batch_size, _len_offset=0, **kw):
+        torch.manual_seed(1)
+        x = torch.randn(24, 5)
+        y = (x.sum(1) > 0).long()
+        m = torch.nn.Linear(5, 2)
+        optim = torch.optim.SGD(m.parameters(), lr=0.5)
+        loss = q.LossWrapper(q.CELoss(mode="logits"))
+        steps = []
+        train_batch = partial(q.train_batch, on_before_optim_step=[lambda: steps.append(1)])
+        dl = q.dataload(x, y, batch_size=batch_size)
+        if _len_offset != 0:
+            dl = WrongLenLoader(dl, len(dl) + _len_offset)
+        q.train_epoch(model=m, dataloader=dl, optim=optim, losses=[loss], _train_batch=train_batch, **kw)
+        return m, loss.get_epoch_error(), len(steps)
+
+    def test_it(self):
+        ref, ref_err, ref_steps = self.run_epoch(12)
+        self.assertEqual(ref_steps, 2)
+        for batch_size, kw in [(12, dict(microbatch=5)), (4, dict(accumulate=3)), (4, dict(accumulate=3, microbatch=3))]:
+            m, err, steps = self.run_epoch(batch_size, **kw)
+            print(kw, err, ref_err)
+            self.assertEqual(steps, 2)
+            self.assertTrue(torch.allclose(m.weight, ref.weight, atol=1e-6))
+            self.assertTrue(torch.allclose(m.bias, ref.bias, atol=1e-6))
+            if "accumulate" not in kw:
+                self.assertTrue(abs(err - ref_err) < 1e-6)
+
+    def test_microbatch_masked_and_sum(self):
+        torch.manual_seed(2)
+        x = torch.randint(1, 10, (8, 6))
+        y = torch.randint(1, 10, (8, 6))
+        for i, l in enumerate([6, 2, 6, 1, 3, 6, 2, 4]):    # 4 rows padded
+            y[i, l:] = 0
+        for loss in [q.CELoss(mode="logits", ignore_index=0), q.CELoss(mode="logits", reduction="sum"),
+                     q.SmoothedCELoss(ignore_index=0, smoothing=0.1)]:
+            results = []
+            for microbatch in [None, 4, 3]:
+                torch.manual_seed(3)
+                m = torch.nn.Sequential(torch.nn.Embedding(10, 5), torch.nn.Linear(5, 10))
+                optim = torch.optim.SGD(m.parameters(), lr=0.1)
+                lw = q.LossWrapper(loss)
+                q.train_epoch(model=m, dataloader=q.dataload(x, y, batch_size=8), optim=optim, losses=[lw],
+                              microbatch=microbatch)
+                results.append((m, lw.get_epoch_error()))
+            (ref, ref_err), others = results[0], results[1:]
+            for m, err in others:
+                print(loss, err, ref_err)
+                self.assertTrue(abs(err - ref_err) < 1e-5)
+                for p, refp in zip(m.parameters(), ref.parameters()):
+                    self.assertTrue(torch.allclose(p, refp, atol=1e-6))
+
+    def test_microbatch_unsupported(self):
+        m = torch.nn.Linear(5, 2)
+        loss = q.LossWrapper(q.CELoss(mode="logits", weight=torch.tensor([1., 2.])))
+        with self.assertRaises(q.SumTingWongException):
+            q.train_epoch(model=m, dataloader=q.dataload(torch.randn(8, 5), torch.randint(0, 2, (8,)), batch_size=8),
+                          optim=torch.optim.SGD(m.parameters(), lr=0.1), losses=[loss], microbatch=3)
+
+    def test_last_window(self):
+        m, err, steps = self.run_epoch(5, accumulate=3)     # 5 batches: windows of 3 and 2
+        self.assertEqual(steps, 2)
+
+    def test_wrong_len(self):
+        # last incomplete window is stepped on (with mean gradient) even if len(dataloader) is wrong
+        ref, _, _ = self.run_epoch(5, accumulate=3)
+        for offset in [-2, 1, 3]:
+            m, err, steps = self.run_epoch(5, accumulate=3, _len_offset=offset)
+            self.assertEqual(steps, 2)
+            self.assertTrue(torch.allclose(m.weight, ref.weight, atol=1e-6))
+
+    def test_lmloader_len(self):
+        from qelos.scripts.lm.rnnlm import LMLoader, VariableSeqlen
+        for n in [1, 2, 10, 11, 12]:
+            loader = LMLoader(torch.arange(n * 2).view(n, 2), VariableSeqlen(minimum=1, mu=5, sigma=0))
+            self.assertEqual(len(loader), len(list(loader)))
+
+
+class TestAutocast(TestCase):
+    def test_dtype_preserving(self):
+        x = torch.randn(4, 6, 8)
+        mask = torch.ones(4, 6, dtype=torch.int64)
+        mask[0, 3:] = 0
+        with q.train._autocast(torch.device("cpu")):
+            dec = q.TransformerDecoder(dim=8, numlayers=1, numheads=2, maxlen=10, noctx=True)     # causal mask
+            y = dec(x, mask=mask)
+            alphas, summary, scores = q.DotAttention()(torch.randn(4, 8), y, ctx_mask=mask)
+        self.assertTrue(torch.all(torch.isfinite(y)))
+        self.assertEqual(scores.dtype, torch.bfloat16)     # bmm output, masking keeps dtype
+        self.assertTrue(torch.all(alphas[0, 3:] == 0))
+        l = q.CELoss(mode="logits")(scores, torch.zeros(4, dtype=torch.int64))
+        self.assertEqual(l.dtype, torch.float32)
+
+    def test_masked_mean(self):
+        torch.manual_seed(0)
+        x = torch.randn(4, 3000, 8).to(torch.bfloat16)
+        mask = (torch.arange(3000)[None, :] < torch.tensor([3000, 2777, 1001, 300])[:, None]).long()
+        ret = q.masked_mean(x, 1, mask=mask.unsqueeze(-1))     # counts > 256 aren't exact in bfloat16
+        self.assertEqual(ret.dtype, torch.bfloat16)
+        ref = (x.float() * mask.unsqueeze(-1)).sum(1) / mask.sum(1, keepdim=True)
+        self.assertTrue(torch.allclose(ret.float(), ref, rtol=1e-2, atol=1e-6))
+        self.assertTrue(torch.equal(ret, ref.to(torch.bfloat16)))
+
+    def test_epochs(self):
+        torch.manual_seed(0)
+        x = torch.randn(64, 5)
+        y = (x.sum(1) > 0).long()
+        m = torch.nn.Linear(5, 2)
+        optim = torch.optim.SGD(m.parameters(), lr=0.5)
+        loss = q.LossWrapper(q.CELoss(mode="logits"))
+        dl = q.dataload(x, y, batch_size=16)
+        for epoch in range(5):
+            q.train_epoch(model=m, dataloader=dl, optim=optim, losses=[loss], autocast=True)
+        self.assertEqual(m.weight.dtype, torch.float32)
+        self.assertTrue(loss.get_epoch_error() < 0.5)
+        testloss = q.LossWrapper(q.CELoss(mode="logits"))
+        q.test_epoch(model=m, dataloader=dl, losses=[testloss], autocast=True)
+        self.assertTrue(abs(testloss.get_epoch_error() - loss.get_epoch_error()) < 0.2)
+        out = q.train.eval_loop(m, q.dataload(x, batch_size=16), autocast=True)
+        self.assertEqual(out.dtype, torch.float32)
+        self.assertEqual(out.size(), (64, 2))
+
+
+class TestStepProfiler(TestCase):
+    def test_it(self):
+        x = torch.randn(64, 5)
+        y = (x.sum(1) > 0).long()
+        m = torch.nn.Linear(5, 2)
+        optim = torch.optim.SGD(m.parameters(), lr=0.5)
+        loss = q.LossWrapper(q.CELoss(mode="logits"), name="ce")
+        dl = q.dataload(x, y, batch_size=16)
+        with tempfile.TemporaryDirectory() as d:
+            profiler = q.StepProfiler(tracepath=os.path.join(d, "trace.json"))
+            train_epoch_f = partial(q.train_epoch, model=m, dataloader=dl, optim=optim, losses=[loss], profiler=profiler)
+            valid_epoch_f = partial(q.test_epoch, model=m, dataloader=dl, losses=[q.LossWrapper(q.CELoss(), name="validce")],
+                                    profiler=profiler)
+            q.run_training(train_epoch_f, valid_epoch_f, max_epochs=2, profiler=profiler)
+            stats = profiler.get_stats()
+            print(profiler.pp())
+            for phase in ["data", "transfer", "forward", "loss:ce", "backward", "hooks", "optim"]:
+                self.assertEqual(stats[("train", phase)]["count"], 4 * (2 if phase == "hooks" else 1))
+            self.assertEqual(set(k for k in stats if k[0] == "test"),
+                             {("test", "data"), ("test", "transfer"), ("test", "forward"), ("test", "loss:validce")})
+            self.assertTrue(stats[("train", "forward")]["p50"] <= stats[("train", "forward")]["p90"])
+            with open(os.path.join(d, "trace.json")) as f:
+                trace = json.load(f)
+            self.assertEqual(len(trace["traceEvents"]), 2 * (4 * 8 + 4 * 4))
+            self.assertEqual(set(e["tid"] for e in trace["traceEvents"]), {0, 1})
+            self.assertEqual(len(profiler.events), 0)       # cleared after every epoch
+            profiler.save_trace()       # nothing new
+            q.train_epoch(model=m, dataloader=dl, optim=optim, losses=[loss], profiler=profiler)
+            profiler.save_trace()
+            with open(os.path.join(d, "trace.json")) as f:
+                trace = json.load(f)
+            self.assertEqual(len(trace["traceEvents"]), 3 * (4 * 8) + 2 * (4 * 4))
+            self.assertEqual(trace["traceEvents"][-1]["tid"], 0)
+
+
+class TestModuleProfiler(TestCase):
+    def test_it(self):
+        m = torch.nn.Sequential(torch.nn.Linear(5, 8), torch.nn.Sequential(torch.nn.ReLU(), torch.nn.Linear(8, 2)))
+        prof = q.ModuleProfiler(m, backward=True)
+        self.assertFalse(prof.enabled)
+        with prof:
+            self.assertTrue(prof.enabled)
+            for _ in range(3):
+                m(torch.randn(4, 5)).sum().backward()
+        self.assertFalse(prof.enabled)
+        self.assertEqual(len(m._forward_hooks) + len(m[1][0]._forward_pre_hooks) + len(m[0]._backward_hooks), 0)
+        m(torch.randn(4, 5)).sum().backward()      # not counted when disabled
+        for path in ["", "0", "1", "1.0", "1.1"]:
+            self.assertEqual(prof.stats[path][1], 3)
+            self.assertEqual(prof.stats[path][4], 3 if path.startswith("1") else 0)     # input doesn't require grad
+        self.assertEqual(prof.stats["0"][2], 3 * 4 * 8 * 4)
+        self.assertEqual(prof.stats["1.1"][2], 3 * 4 * 2 * 4)
+        self.assertTrue(prof.stats[""][0] >= prof.stats["1"][0] >= prof.stats["1.1"][0] > 0)
+        report = prof.report()
+        print(report)
+        lines = report.split("\n")
+        self.assertEqual(len(lines), 1 + 5)
+        self.assertTrue(lines[1].startswith("(model) (Sequential)"))
+        self.assertTrue(lines[-1].startswith("    ") or lines[-2].startswith("    "))
+        self.assertEqual(len(prof.report(maxdepth=1).split("\n")), 1 + 3)
+        prof.reset()
+        self.assertEqual(prof.stats["0"][1], 0)
+
+    def test_packed_and_no_grad_inputs(self):
+        m = torch.nn.Sequential(torch.nn.Embedding(10, 5), q.LSTMEncoder(5, 6, 7))
+        x = torch.randint(1, 10, (4, 6))
+        mask = (torch.arange(6)[None, :] < torch.tensor([3, 6, 2, 5])[:, None]).long()
+        with q.ModuleProfiler(m, backward=True) as prof:
+            for _ in range(2):
+                emb = m[0](x)
+                m[1](emb, mask=mask).sum().backward()        # LSTM layers get PackedSequences
+        for path in ["1", "1.layers.0", "1.layers.1"]:
+            self.assertEqual(prof.stats[path][4], 2)
+            self.assertTrue(prof.stats[path][3] > 0)
+        self.assertEqual(prof.stats["0"][4], 0)     # embedding of ids: backward not measurable
+        report = prof.report()
+        print(report)
+        embline = [line for line in report.split("\n") if line.strip().startswith("0 (Embedding)")][0]
+        self.assertTrue("n/a" in embline)
+
+    def test_inplace(self):
+        m = torch.nn.Sequential(torch.nn.Linear(5, 8), torch.nn.ReLU(inplace=True), torch.nn.Linear(8, 2))
+        for backward in [False, True]:
+            with q.ModuleProfiler(m, backward=backward) as prof:
+                for _ in range(2):
+                    m(torch.randn(4, 5, requires_grad=True)).sum().backward()
+            for path in ["", "0", "1", "2"]:
+                self.assertEqual(prof.stats[path][1], 2)
+            for path in ["0", "2"]:
+                self.assertEqual(prof.stats[path][4], 2 if backward else 0)
+            for path in ["", "1"]:      # contain an in-place module: inputs not marked
+                self.assertEqual(prof.stats[path][4], 0)
+            lines = {line.strip().split(" ")[0]: line for line in prof.report().split("\n")[1:]}
+            self.assertTrue("n/a" in lines["1"])
+            self.assertTrue(("n/a" in lines["0"]) != backward)
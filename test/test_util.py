@@ -0,0 +1,328 @@
+from unittest import TestCase, mock
+import functools
+import itertools
+import os
+import tempfile
+import qelos as q
+import numpy as np
+import torch
+
+
+class TestStringMatrix(TestCase):
+    def test_finalize_rare(self):
+        sm = q.StringMatrix(freqcutoff=2)
+        sm.tokenize = lambda s: s.split()
+        sm.add("the cat sat")
+        sm.add("the dog sat down")
+        sm.add("the cat")
+        sm.finalize()
+        print(sm.matrix)
+        print(sm.D)
+        self.assertEqual(sm.matrix.shape, (3, 4))
+        self.assertEqual(sm.D["the"], 4)
+        self.assertEqual(set(sm.D.keys()), set(sm.protectedwords) | {"the", "cat", "sat"})
+        self.assertEqual(sm._rarewords, {"dog", "down"})
+        self.assertEqual(sm[1], "the <RARE> sat <RARE>")
+        self.assertTrue(np.all(sm.matrix[2, 2:] == 0))
+
+    def test_ragged_pad(self):
+        sm = q.StringMatrix()
+        sm.tokenize = lambda s: s.split()
+        sm.add("a b c d e f")
+        sm.add("a")
+        sm.add("b c")
+        self.assertEqual(sm[2], [5, 6])
+        sm.finalize()
+        print(sm._tokens.dtype)
+        self.assertEqual(sm._tokens.dtype, np.uint8)
+        self.assertEqual(list(sm.lengths), [6, 1, 2])
+        batch = sm.pad([1, 2])
+        print(batch)
+        self.assertEqual(batch.shape, (2, 2))
+        self.assertEqual(batch.dtype, np.int64)
+        self.assertTrue(np.all(batch == sm.matrix[[1, 2], :2]))
+        self.assertEqual(sm.matrix.shape, (3, 6))
+        self.assertEqual(sm[2], "b c")
+        self.assertEqual(sm[1:], ["a", "b c"])
+
+    def test_add_many(self):
+        data = ["the cat sat", "a dog", "", "the dog sat on the cat", "a bird"] * 7
+
+        def build(add_many=False, external=None, **kw):
+            sm = q.StringMatrix(freqcutoff=2, indicate_start_end=True)
+            sm.tokenize = str.split
+            if external is not None:
+                sm.set_dictionary(external)
+            if add_many:
+                sm.add_many(data, chunksize=3, **kw)
+            else:
+                for x in data:
+                    sm.add(x)
+            sm.finalize()
+            return sm
+
+        ref = build()
+        for workers in [1, 2]:
+            sm = build(add_many=True, workers=workers)
+            self.assertEqual(sm.D, ref.D)
+            self.assertTrue(np.all(sm.matrix == ref.matrix))
+
+        D = {"<MASK>": 0, "<RARE>": 1, "<START>": 2, "<END>": 3, "the": 4, "cat": 5}
+        ref = build(external=D)
+        sm = build(add_many=True, external=D, workers=2)
+        print(sm[3])
+        self.assertEqual(sm[3], "<START> the <RARE> <RARE> <RARE> the cat <END>")
+        self.assertTrue(np.all(sm.matrix == ref.matrix))
+
+    def test_cached(self):
+        data = ["the cat sat", "a dog", "the dog sat on the cat"]
+        with tempfile.TemporaryDirectory() as d:
+            sm = q.StringMatrix(indicate_end=True)
+            sm.tokenize = str.split
+            sm.cached(d, data)
+            self.assertEqual(len(os.listdir(d)), 3)
+
+            sm2 = q.StringMatrix(indicate_end=True)
+            sm2.tokenize = str.split
+            sm2.cached(d, data)
+            self.assertTrue(isinstance(sm2._tokens, np.memmap))
+            self.assertEqual(sm2.D, sm.D)
+            self.assertTrue(np.all(sm2.matrix == sm.matrix))
+            self.assertEqual(sm2[2], "the dog sat on the cat <END>")
+
+            sm3 = q.StringMatrix(indicate_end=False)
+            sm3.tokenize = str.split
+            sm3.cached(d, data)
+            self.assertEqual(len(os.listdir(d)), 6)
+            self.assertEqual(sm3[2], "the dog sat on the cat")
+
+            sm4 = q.StringMatrix.load(sm._cache_p)
+            self.assertTrue(np.all(sm4.matrix == sm.matrix))
+
+    def test_cached_tokenizers(self):
+        data = ["The cat sat", "a Dog"]
+
+        def build(d, tokenize, **kw):
+            sm = q.StringMatrix()
+            sm.tokenize = tokenize
+            return sm.cached(d, data, **kw)
+
+        with tempfile.TemporaryDirectory() as d:
+            a = build(d, lambda s: s.split())
+            b = build(d, lambda s: s.lower().split())       # different lambda: no cache hit
+            self.assertNotEqual(a._cache_p, b._cache_p)
+            self.assertEqual(b[0], "the cat sat")
+            c = build(d, lambda s: s.split())               # same code: cache hit
+            self.assertEqual(c._cache_p, a._cache_p)
+            self.assertTrue(isinstance(c._tokens, np.memmap))
+
+            p1 = build(d, functools.partial(split_tokenize, lower=True))
+            p2 = build(d, functools.partial(split_tokenize, lower=True))
+            self.assertEqual(p1._cache_p, p2._cache_p)
+            self.assertNotEqual(p1._cache_p, build(d, functools.partial(split_tokenize, lower=False))._cache_p)
+            self.assertEqual(build(d, q.Tokenizer(fast=True))._cache_p, build(d, q.Tokenizer(fast=True))._cache_p)
+
+            with self.assertRaises(q.SumTingWongException):     # only identified by address
+                build(d, SplitTokenizer())
+            e = build(d, SplitTokenizer(), tokenizer_id="split")
+            self.assertEqual(e._cache_p, build(d, SplitTokenizer(), tokenizer_id="split")._cache_p)
+
+
+def split_tokenize(s, lower=False):
+    return (s.lower() if lower else s).split()
+
+
+class SplitTokenizer(object):
+    def __call__(self, s):
+        return s.split()
+
+
+class TestTokenizer(TestCase):
+    def test_fast(self):
+        t = q.Tokenizer(fast=True, preserve_patterns=["<e\\d+>"])
+        tokens = t("Don't call <e0> at 3.5 o'clock, it's-late!")
+        print(tokens)
+        self.assertEqual(tokens, ["do", "n't", "call", "<e0>", "at", "3.5", "o", "'", "clock", ",", "it", "'s", "late", "!"])
+
+    def test_cache(self):
+        t = q.Tokenizer(fast=True, cachesize=2)
+        a = t("a b")
+        a.append("c")   # returned tokens can be modified without affecting cache
+        self.assertEqual(t("a b"), ["a", "b"])
+        t("c d")
+        t("e f")
+        self.assertEqual(list(t._cache.keys()), ["c d", "e f"])
+        self.assertEqual((t.hits, t.misses), (1, 3))
+
+
+class TestBucketedBatchSampler(TestCase):
+    def test_it(self):
+        lengths = np.random.randint(1, 50, (1000,))
+        sampler = q.BucketedBatchSampler(lengths, batch_size=32, shuffle=True, shuffle_buckets=True, bucketsize=64)
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        self.assertEqual(sorted(sum(batches, [])), list(range(1000)))
+        self.assertTrue(all(len(batch) <= 32 for batch in batches))
+        padded = sum(len(batch) * lengths[batch].max() for batch in batches)
+        print(padded, lengths.sum(), len(lengths) * lengths.max())
+        self.assertTrue(padded < 1.2 * lengths.sum())
+        self.assertNotEqual(batches, list(sampler))
+
+    def test_max_tokens(self):
+        mask = np.zeros((100, 20), dtype="int64")
+        lengths = np.random.randint(1, 21, (100,))
+        for i, l in enumerate(lengths):
+            mask[i, :l] = 1
+        sampler = q.BucketedBatchSampler(mask, max_tokens=60, shuffle=True)
+        batches = list(sampler)
+        self.assertEqual(sorted(sum(batches, [])), list(range(100)))
+        for batch in batches:
+            self.assertTrue(len(batch) * lengths[batch].max() <= 60)
+
+    def test_len(self):
+        lengths = np.random.randint(1, 50, (1000,))
+        for kw in [dict(batch_size=32), dict(batch_size=32, drop_last=True), dict(max_tokens=300),
+                   dict(max_tokens=300, batch_size=8)]:
+            sampler = q.BucketedBatchSampler(lengths, shuffle=True, shuffle_buckets=True, bucketsize=64, **kw)
+            for epoch in range(3):
+                n = len(sampler)
+                count = 0
+                for batch in sampler:
+                    self.assertEqual(len(sampler), n)       # constant (and cheap) during epoch
+                    count += 1
+                self.assertEqual(count, n, kw)
+        sampler = q.BucketedBatchSampler(lengths, max_tokens=300)
+        with mock.patch.object(sampler, "_make_batches", wraps=sampler._make_batches) as make_batches:
+            for i in range(10):
+                len(sampler)
+            list(sampler)
+            self.assertEqual(make_batches.call_count, 1)
+
+    def test_dataload_drop_last(self):
+        x = np.random.randint(1, 10, (50, 12))
+        dl = q.dataload(x, batch_size=8, bucket=0, drop_last=True)
+        self.assertEqual(len(dl), 6)
+        self.assertEqual(sum(len(batch[0]) for batch in dl), 48)
+        with self.assertRaises(q.SumTingWongException):
+            q.dataload(x, max_tokens=30, bucket=0, drop_last=True)
+
+    def test_dataload(self):
+        x = np.random.randint(1, 10, (50, 12))
+        for i in range(50):
+            x[i, i % 12 + 1:] = 0
+        dl = q.dataload(x, np.arange(50), batch_size=8, shuffle=True, bucket=0)
+        total = 0
+        for xb, ib in dl:
+            lens = (xb != 0).sum(1)
+            self.assertTrue((lens.max() - lens.min()).item() <= 4)
+            total += len(ib)
+        self.assertEqual(total, 50)
+
+
+class ListDataset(torch.utils.data.Dataset):
+    def __init__(self, n):
+        super(ListDataset, self).__init__()
+        self.n = n
+
+    def __getitem__(self, i):
+        return torch.tensor(i * 10), torch.tensor([i, i])
+
+    def __len__(self):
+        return self.n
+
+
+class TestBatchedLoading(TestCase):
+    def test_multidatasets(self):
+        x = torch.randn(20, 3)
+        y = torch.arange(20)
+        ds = q.datacat([q.tensor_dataset(x, y), ListDataset(20)])
+        batch = ds[[3, 1, 7]]
+        self.assertEqual(len(batch), 4)
+        self.assertTrue(torch.equal(batch[0], x[[3, 1, 7]]))
+        self.assertEqual(batch[2].tolist(), [30, 10, 70])
+        self.assertEqual(batch[3].size(), (3, 2))
+        single = ds[3]
+        self.assertTrue(torch.equal(single[0], x[3]))
+
+    def test_dataload_batched(self):
+        x = torch.randn(21, 3)
+        y = torch.arange(21)
+        for tensors in [(x, y), (q.tensor_dataset(x, y), ListDataset(21))]:
+            a = list(q.dataload(*tensors, batch_size=4))
+            b = list(q.dataload(*tensors, batch_size=4, batched=True))
+            self.assertEqual(len(a), len(b))
+            for ae, be in zip(a, b):
+                self.assertEqual(len(ae), len(be))
+                for aee, bee in zip(ae, be):
+                    self.assertTrue(torch.equal(aee, bee))
+        seen = torch.cat([batch[1] for batch in q.dataload(x, y, batch_size=4, shuffle=True, batched=True)])
+        self.assertEqual(sorted(seen.tolist()), list(range(21)))
+
+
+class TestDatasplit(TestCase):
+    def test_index_and_view(self):
+        x = np.arange(100).reshape(50, 2)
+        y = np.arange(50)
+        state = np.random.get_state()
+        ref = q.datasplit([x, y], splits=(70, 30), random=5)
+        np.random.set_state(state)
+        idxs = q.datasplit([x, y], splits=(70, 30), random=5, mode="index")
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip(np.random.get_state()[1:], state[1:])))
+        views = q.datasplit([x, y], splits=(70, 30), random=5, mode="view")
+        for refsplit, idxs_i, view in zip(ref, idxs, views):
+            self.assertTrue(np.all(refsplit[1] == idxs_i))
+            self.assertEqual(len(view), len(idxs_i))
+            self.assertTrue(np.all(view[list(range(len(view)))][0].numpy() == refsplit[0]))
+
+    def test_unseeded(self):
+        x = np.arange(200)
+        splits = [tuple(q.datasplit([x], splits=(50, 50), random=True, mode="index")[0]) for _ in range(5)]
+        self.assertTrue(len(set(splits)) > 1)       # not the same split every call
+        for split in splits:
+            self.assertEqual(len(split), 100)
+
+    def test_contiguous(self):
+        with tempfile.TemporaryDirectory() as d:
+            x = np.lib.format.open_memmap(os.path.join(d, "x.npy"), mode="w+", dtype="float32", shape=(40, 3))
+            x[:] = np.arange(120).reshape(40, 3)
+            train, test = q.datasplit([x], splits=(3, 1), random=False, mode="index")
+            self.assertEqual((train, test), (slice(0, 30), slice(30, 40)))
+            train, test = q.datasplit([x], splits=(3, 1), random=False, mode="view")
+            self.assertTrue(np.shares_memory(train.arrays[0], x))
+            batches = list(q.dataload(test, batch_size=4, batched=True))
+            self.assertEqual(len(batches), 3)
+            self.assertTrue(torch.equal(torch.cat([b[0] for b in batches]), torch.tensor(x[30:])))
+            del train, test, batches, x
+
+
+class FailingDataset(torch.utils.data.Dataset):
+    def __getitem__(self, i):
+        if i == 5:
+            raise q.SumTingWongException("broken example")
+        return torch.tensor(i)
+
+    def __len__(self):
+        return 10
+
+
+class TestBatchPrefetcher(TestCase):
+    def test_it(self):
+        x = torch.randn(50, 3)
+        dl = q.dataload(x, torch.arange(50), batch_size=8)
+        pf = q.BatchPrefetcher(dl, device=torch.device("cpu"), depth=3)
+        self.assertEqual(len(pf), len(dl))
+        for a, b in zip(dl, pf):
+            self.assertTrue(torch.equal(a[0], b[0]) and torch.equal(a[1], b[1]))
+        self.assertEqual(pf.num_batches, 7)
+        print(pf.pp_stalls())
+        for i, batch in enumerate(pf):      # stopping early must not hang
+            if i == 2:
+                break
+        batches = [batch for batch, info in itertools.islice(q.inf_batches(dl, prefetch=2), 10)]
+        self.assertTrue(torch.equal(batches[7][1], torch.arange(0, 8)))
+
+    def test_exception(self):
+        pf = q.BatchPrefetcher(q.dataload(FailingDataset(), batch_size=2), depth=2)
+        with self.assertRaises(q.SumTingWongException):
+            for batch in pf:
+                pass
@@ -1,9 +1,13 @@
-from unittest import TestCase
+from unittest import TestCase, mock
+import gzip
+import os
+import tempfile
 import qelos as q
 from torch.autograd import Variable
 import torch
 from torch import nn
 import numpy as np
+import json
 
 
 class TestWordEmb(TestCase):
@@ -111,3 +115,300 @@ class TestSwitchedWordEmb(TestCase):
         self.assertTrue(np.allclose(y.detach().numpy(), y_ref.detach().numpy()))
         print(y.size())
 
+
+class TestSwitchedWordEmbGrad(TestCase):
+    def test_grad(self):
+        D = "<MASK> <RARE> cat dog person earlgreytea the".split()
+        D = dict(zip(D, range(len(D))))
+        base = q.WordEmb(5, worddic=D)
+        switched = q.SwitchedWordEmb(base)
+        over1, over2 = q.WordEmb(5, worddic=D), q.WordEmb(5, worddic=D)
+        switched.override(over1, selectwords=["cat", "dog"])
+        switched.override(over2, selectwords=["dog", "the"])
+        x = torch.tensor([[2, 3, 6, 0], [4, 4, 5, 0]])
+        y, ymask = switched(x)
+        self.assertEqual(y.size(), (2, 4, 5))
+        self.assertTrue(torch.equal(ymask, (x != 0).int()))
+        self.assertTrue(torch.allclose(y[0, 0], over1.weight[2]))
+        self.assertTrue(torch.allclose(y[0, 1], over2.weight[3]))
+        self.assertTrue(torch.allclose(y[1, 2], base.weight[5]))
+        y.sum().backward()
+        rows = lambda emb: set(emb.weight.grad.abs().sum(1).nonzero().squeeze(-1).tolist())
+        self.assertEqual(rows(base), {4, 5})
+        self.assertEqual(rows(over1), {2})
+        self.assertEqual(rows(over2), {3, 6})
+
+    def test_all_overridden(self):
+        D = "<MASK> <RARE> cat dog person earlgreytea the".split()
+        D = dict(zip(D, range(len(D))))
+        base = q.WordEmb(5, worddic=D, word_dropout=0.5)
+        switched = q.SwitchedWordEmb(base)
+        over = q.WordEmb(5, worddic=D)
+        switched.override(over, selectwords=["cat", "dog"])
+        switched.train()
+        x = torch.tensor([[2, 3, 3], [2, 2, 3]])    # base embedder gets no ids
+        y, ymask = switched(x)
+        self.assertEqual(y.size(), (2, 3, 5))
+        kept = ~(y == 0).all(-1)
+        self.assertTrue(torch.allclose(y[kept], over.weight[x[kept]]))
+        y, _ = switched(torch.zeros(0, 3, dtype=torch.int64))
+        self.assertEqual(y.size(), (0, 3, 5))
+
+
+class TestWordEmbStorage(TestCase):
+    def test_it(self):
+        D = dict(zip("<MASK> <RARE> the a cat dog sat on mat".split(), range(9)))
+        emb = q.WordEmb(10, worddic=D)
+        W = emb.weight.detach().clone()
+        x = torch.tensor([[2, 4, 5, 0], [3, 3, 8, 0]])
+
+        emb.set_storage("float16")
+        self.assertEqual(emb.storage, "float16")
+        y, ymask = emb(x)
+        self.assertEqual(y.dtype, torch.float32)
+        self.assertTrue(torch.allclose(y, W[x], atol=1e-3))
+        optim = torch.optim.SGD(emb.parameters(), lr=1.)
+        y.sum().backward()
+        optim.step()
+        self.assertEqual(emb.weight.dtype, torch.float16)
+        self.assertTrue(torch.allclose(emb.weight[2].float(), W[2] - 1, atol=1e-2))
+        self.assertTrue(torch.allclose(emb.weight[7].float(), W[7], atol=1e-3))
+
+        emb = q.WordEmb(10, worddic=D, _weight=W.clone()).freeze(storage="int8")
+        self.assertEqual(list(emb.parameters()), [])
+        y, ymask = emb(x)
+        print((y - W[x]).abs().max())
+        self.assertTrue(torch.allclose(y, W[x], atol=W.abs().max().item() / 127))
+        with self.assertRaises(q.SumTingWongException):
+            emb.freeze(False)
+
+        emb = q.WordEmb.load_pretrained(W.numpy().astype("float16"), D, storage="bfloat16")
+        self.assertEqual(emb.weight.dtype, torch.bfloat16)
+        self.assertTrue(torch.allclose(emb(x)[0], W[x], atol=1e-2))
+
+
+class TestWordEmbIndex(TestCase):
+    def test_it(self):
+        emb = q.WordEmb.load_pretrained_path("../data/glove/miniglove.50d")
+        W = emb.weight.detach()
+        W = W / W.norm(dim=1, keepdim=True).clamp(min=1e-12)
+        queries = torch.tensor([emb.D[w] for w in ["the", "said", "of"]])
+        refscores, refids = torch.matmul(W[queries], W.t()).topk(6, 1)     # includes query word itself
+
+        index = emb.nn_index(chunksize=100)
+        scores, ids = index.search(queries, k=5)
+        self.assertTrue(torch.equal(ids, refids[:, 1:]))
+        self.assertTrue(torch.allclose(scores, refscores[:, 1:], atol=1e-5))
+        scores, ids = index.search(emb(queries)[0], k=6)    # query vectors
+        self.assertTrue(torch.equal(ids, refids))
+
+        nearest = index.nearest("the", k=3)
+        print(nearest)
+        self.assertEqual([w for w, s in nearest], [index.rD[i] for i in refids[0, 1:4].tolist()])
+
+        index = emb.nn_index(numclusters=10, nprobe=10)     # all clusters probed --> exact
+        scores, ids = index.search(queries, k=5)
+        self.assertTrue(torch.equal(ids, refids[:, 1:]))
+        index = emb.nn_index(numclusters=20, nprobe=3)
+        self.assertEqual(sorted(index.cluster_order.tolist()), list(range(len(index.ids))))
+        print(index.nearest(["the", "said"], k=3))
+
+    def test_missing_ids(self):
+        D = {"<MASK>": 0, "a": 1, "b": 2, "c": 3}
+        index = q.WordEmb(5, worddic=D).nn_index()
+        scores, ids = index.search(torch.tensor([1, 3]), k=2)
+        self.assertEqual([sorted(ids_i) for ids_i in ids.tolist()], [[2, 3], [1, 2]])     # mask word isn't indexed
+        for ids in [[1, 0], [4], [2, -1]]:      # mask id and ids out of vocabulary aren't in the index
+            with self.assertRaises(q.SumTingWongException):
+                index.search(torch.tensor(ids))
+        with self.assertRaises(q.SumTingWongException):
+            index.nearest("<MASK>")
+
+
+class TestWordLinoutShortlist(TestCase):
+    def test_it(self):
+        D = dict(zip("<MASK> <RARE> the a cat dog sat on mat".split(), range(9)))
+        linout = q.WordLinout(5, worddic=D)
+        x = torch.randn(3, 5)
+        full = linout(x)
+        with linout.shortlisted(ids=torch.tensor([[6, 4], [4, 7]]), words=["mat", "unknownword"], topn=3):
+            print(linout.shortlist)
+            self.assertEqual(linout.shortlist.tolist(), [0, 1, 2, 4, 6, 7, 8])
+            y = linout(x)
+            self.assertEqual(y.size(), (3, 7))
+            self.assertTrue(torch.allclose(y, full[:, linout.shortlist]))
+            self.assertTrue(torch.equal(linout.to_global(torch.tensor([0, 4, 6])), torch.tensor([0, 6, 8])))
+        self.assertTrue(linout.shortlist is None)
+        linout.set_shortlist(topn=2, counts={"cat": 10, "dog": 3, "the": 5})
+        self.assertEqual(linout.shortlist.tolist(), [2, 4])
+        linout.set_shortlist()
+        self.assertEqual(linout(x).size(), (3, 9))
+
+    def test_free_decoder(self):
+        D = dict(zip("<MASK> <RARE> the a cat dog sat on mat".split(), range(9)))
+        linout = q.WordLinout(5, worddic=D)
+        emb = RecordingEmb(5, worddic=D)
+        cell = EmbOutCell(emb, linout)
+        decoder = q.FreeDecoder(cell, maxtime=4)
+        with linout.shortlisted(ids=[5, 7, 8]):
+            y = decoder(torch.tensor([2, 3]))
+        self.assertEqual(y.size(), (2, 4, 3))
+        self.assertEqual(len(emb.seen), 4)
+        for x in emb.seen[1:]:      # fed back argmaxes are global ids
+            self.assertTrue(set(x.tolist()) <= {5, 7, 8})
+
+
+class EmbOutCell(torch.nn.Module):
+    def __init__(self, emb, out):
+        super(EmbOutCell, self).__init__()
+        self.emb, self.out = emb, out
+
+    def forward(self, x_t):
+        return self.out(self.emb(x_t)[0])
+
+
+class RecordingEmb(q.WordEmb):
+    def forward(self, x):
+        self.__dict__.setdefault("seen", []).append(x)
+        return super(RecordingEmb, self).forward(x)
+
+
+class TestAdaptiveWordLinout(TestCase):
+    def test_it(self):
+        D = dict(zip(["<MASK>"] + ["w{}".format(i) for i in range(1, 40)], range(40)))
+        counts = np.random.randint(1, 100, (40,))
+        linout = q.AdaptiveWordLinout(8, worddic=D, counts=counts, cutoffs=[5, 15])
+        self.assertEqual(linout.cutoffs, [5, 15])
+        # most frequent words are in the head
+        self.assertEqual(set(linout.rank2id[:5].tolist()), set(np.argsort(-counts, kind="stable")[:5].tolist()))
+        x = torch.randn(3, 4, 8)
+        logprobs = linout(x)
+        self.assertEqual(logprobs.size(), (3, 4, 40))
+        self.assertTrue(torch.allclose(logprobs.exp().sum(-1), torch.ones(3, 4), atol=1e-5))
+
+        gold = torch.randint(1, 40, (3, 4))
+        gold[:, -1] = 0
+        goldlogprobs = linout.gold_log_prob(x, gold)
+        self.assertTrue(torch.allclose(goldlogprobs, logprobs.gather(-1, gold.unsqueeze(-1)).squeeze(-1), atol=1e-5))
+
+        l = q.AdaptiveCELoss(linout, ignore_index=0)(x, gold)
+        lref = q.CELoss(mode="logprobs", ignore_index=0)(logprobs, gold)
+        print(l, lref)
+        self.assertTrue(abs(l.item() - lref.item()) < 1e-5)
+        l.backward()
+        self.assertTrue(linout.asm.head.weight.grad is not None)
+
+
+class TestLoadPretrained(TestCase):
+    def test_select(self):
+        W = np.random.randn(6, 4).astype("float32")
+        D = dict(zip("a b c d e f".split(), range(6)))
+        selectD = {"<MASK>": 0, "f": 1, "b": 2, "zzz": 3, "a": 4}
+        emb = q.WordEmb.load_pretrained(W, D, selectD=selectD)
+        self.assertEqual(emb.D, {"f": 1, "b": 2, "a": 4})
+        w = emb.weight.detach().numpy()
+        self.assertTrue(np.allclose(w[[1, 2, 4]], W[[5, 1, 0]]))
+        self.assertTrue(np.allclose(w[[0, 3]], 0))
+        b = np.random.randn(6).astype("float32")
+        linout = q.WordLinout.load_pretrained(W, b, D=D, selectD=selectD)
+        self.assertTrue(np.allclose(linout.bias.detach().numpy()[[1, 2, 4]], b[[5, 1, 0]]))
+        self.assertTrue(np.allclose(linout.weight.detach().numpy(), w))
+
+    def test_mmap(self):
+        W, D = q.WordEmb._load_path("../data/glove/miniglove.50d", mmap_mode="r")
+        self.assertTrue(isinstance(W, np.memmap))
+        selectD = {"the": 0, "said": 1, "of": 2}
+        emb = q.WordEmb.load_pretrained_path("../data/glove/miniglove.50d", selectD=selectD)
+        self.assertTrue(np.allclose(emb.weight.detach().numpy(), np.asarray(W)[[D["the"], D["said"], D["of"]]]))
+
+
+class TestTransformToFormat(TestCase):
+    def test_it(self):
+        W, D = q.WordEmb._load_path("../data/glove/miniglove.50d")
+        words = sorted(D.keys(), key=lambda x: D[x])[:100]
+        words[5] = "new york"   # words can contain spaces
+        lines = [" ".join([word] + ["{:.6f}".format(x) for x in W[i]]) for i, word in enumerate(words)]
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, "glove.txt"), "w") as f:
+                f.write("\n".join(lines) + "\n")
+            with gzip.open(os.path.join(d, "w2v.txt.gz"), "wt") as f:
+                f.write("\n".join(["100 50"] + lines))
+            numwords, dim = q.WordEmb.transform_to_format(os.path.join(d, "glove.txt"), os.path.join(d, "glove"),
+                                                          chunksize=7)
+            self.assertEqual((numwords, dim), (100, 50))
+            q.WordEmb.transform_to_format(os.path.join(d, "w2v.txt.gz"), os.path.join(d, "w2v"), dtype="float16")
+            glove = q.WordEmb.load_pretrained_path(os.path.join(d, "glove"))
+            self.assertEqual(glove.D["new york"], 5)
+            self.assertTrue(np.allclose(glove.weight.detach().numpy(), W[:100], atol=1e-6))
+            w2v = q.WordEmb.load_pretrained_path(os.path.join(d, "w2v"), selectD={"the": 0, "new york": 1})
+            self.assertEqual(w2v.weight.dtype, torch.float32)
+            self.assertTrue(np.allclose(w2v.weight.detach().numpy(), W[[0, 5]], atol=1e-2))
+            with open(os.path.join(d, "glove.words")) as f:
+                self.assertEqual(json.load(f), words)
+
+            # stale .vocab (older than .words) isn't used
+            p = os.path.join(d, "glove")
+            with open(p + ".words", "w") as f:
+                json.dump(list(reversed(words)), f)
+            os.utime(p + ".vocab", (0, 0))
+            _, D = q.WordEmb._load_path(p)
+            self.assertEqual(D["new york"], 94)
+            # words must match vectors
+            os.remove(p + ".words")
+            with open(p + ".vocab", "w") as f:
+                f.write("\n".join(words[:-1]))
+            with self.assertRaises(q.SumTingWongException):
+                q.WordEmb._load_path(p)
+
+
+class TestCachedSelection(TestCase):
+    def test_it(self):
+        path = "../data/glove/miniglove.50d"
+        selectD = {"<MASK>": 0, "the": 1, "of": 2, "said": 3}
+        ref = q.WordEmb.load_pretrained_path(path, selectD=selectD)
+        with tempfile.TemporaryDirectory() as d:
+            first = q.WordEmb.load_pretrained_path(path, selectD=selectD, cachedir=d)
+            self.assertEqual(len(os.listdir(d)), 2)
+            with mock.patch.object(q.WordEmb, "_load_path", None):    # cache hit must not read the vectors again
+                second = q.WordEmb.load_pretrained_path(path, selectD=selectD, cachedir=d)
+            for emb in [first, second]:
+                self.assertEqual(emb.D, ref.D)
+                self.assertTrue(np.allclose(emb.weight.detach().numpy(), ref.weight.detach().numpy()))
+            q.WordEmb.load_pretrained_path(path, selectD={"the": 0, "of": 1}, cachedir=d)
+            self.assertEqual(len(os.listdir(d)), 4)
+
+
+class TestWordDropout(TestCase):
+    def test_it(self):
+        D = dict(zip(["<MASK>"] + ["w{}".format(i) for i in range(1, 1000)], range(1000)))
+        m = q.WordEmb(10, worddic=D, word_dropout=0.5)
+        m.train()
+        x = torch.randint(1, 1000, (8, 30))
+        x[:, 0] = 7
+        y, _ = m(x)
+        dropped = (y == 0).all(-1)
+        self.assertEqual(len(set(dropped[:, 0].tolist())), 1)    # same word dropped everywhere in batch
+        self.assertTrue(0 < dropped.float().mean().item() < 1)
+        for i in range(x.size(0)):
+            for j in range(x.size(1)):
+                self.assertEqual(dropped[i, j].item(), dropped[x == x[i, j]][0].item())
+        self.assertTrue(len(m._word_dropout_mask[0]) <= 8 * 30)
+
+        # next call in same batch: known words keep their mask, new words get sampled
+        x2 = torch.cat([x[:, :5], torch.randint(1, 1000, (8, 5))], 1)
+        y2, _ = m(x2)
+        self.assertTrue(torch.equal((y2[:, :5] == 0).all(-1), dropped[:, :5]))
+        known_ids, known_mask = m._word_dropout_mask
+        self.assertTrue(torch.equal(known_ids, torch.unique(torch.cat([x.flatten(), x2.flatten()]))))
+
+        q.batch_reset(m)
+        self.assertTrue(m._word_dropout_mask is None)
+        y, _ = m(torch.zeros(2, 0, dtype=torch.int64))      # empty batch, also with an empty cached mask
+        self.assertEqual(y.size(), (2, 0, 10))
+        m._word_dropout_mask = (torch.zeros(0, dtype=torch.int64), torch.zeros(0, 1))
+        y, _ = m(x)
+        self.assertEqual(len(m._word_dropout_mask[0]), len(torch.unique(x)))
+        q.batch_reset(m)
+        m.eval()
+        y, _ = m(x)
+        self.assertFalse((y == 0).all(-1).any())